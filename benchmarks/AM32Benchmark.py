@@ -0,0 +1,333 @@
+#!python3
+# -*- coding: utf-8 -*-
+
+"""
+    Benchmark suite for the AM32Connector and AM32eeprom hot paths.
+    Results are compared against the stored baseline, a slowdown above the threshold fails the run.
+
+    usage: python benchmarks/AM32Benchmark.py [--update-baseline] [--threshold 0.25] [--filter crc16]
+
+    Baselines are machine specific, refresh them with --update-baseline on the machine used
+    for comparing before measuring a change. A baseline of another host is shown but does not fail the run.
+
+    Copyright Julian Wingert, 2023, Licensed under the GPL V3
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from AM32Connector import AM32Connector
+from AM32eeprom import AM32eeprom
+from AM32eepromCodec import AM32eepromCodec
+from AM32FlashPlan import AM32FlashPlan, AM32FlashPlanCache
+from AM32Telemetry import AM32TelemetryDecoder, AM32TelemetryStatistics, TELEMETRY_FRAME, crc8
+from AM32FakeESC import AM32FakeESC
+
+
+__author__ = 'Julian Wingert'
+__copyright__ = 'Copyright 2023, AM32 ESC Setup Tool'
+__license__ = 'GPL V3'
+__version__ = '0.1'
+__maintainer__ = 'Julian Wingert'
+__status__ = 'testing'
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_THRESHOLD = 0.25
+RANDOM_SEED = 0x4d32
+MIN_SAMPLE_TIME = 0.05
+
+# representative AM32 image sizes: small test image, F051 (32k flash), G071 (64k flash)
+FIRMWARE_SIZES = {"4k": 4 * 1024, "28k": 28 * 1024, "60k": 60 * 1024}
+
+# end to end runs go through the connector's sleeps, keep them short but not zero
+E2E_WAIT_AFTER_WRITE = 0.001
+E2E_LATENCY = 0.0005
+# share of NACKed commands in the noisy end to end benchmark
+NOISY_ERROR_RATE = 0.05
+# share of write flash commands whose ACK is lost in the lost ACK end to end benchmark
+LOST_ACK_RATE = 0.05
+
+
+class BenchmarkContext:
+    """Shared, deterministic benchmark data (firmware files, eeprom images, connectors)"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        rng = random.Random(RANDOM_SEED)
+
+        self.firmware_files = {}
+        self.firmware_images = {}
+        for name, size in FIRMWARE_SIZES.items():
+            filename = os.path.join(directory, "firmware_%s.bin" % name)
+            image = rng.randbytes(size)
+            with open(filename, mode="wb") as bin_file:
+                bin_file.write(image)
+            self.firmware_files[name] = filename
+            self.firmware_images[name] = image
+
+        self.chunk = bytearray(rng.randbytes(AM32Connector.CHUNK_SIZE))
+        self.eeprom_bytes = AM32eeprom().get_eeprom_bytearray()
+        self.eeprom_dump = bytes(self.eeprom_bytes) * 10000
+
+        # one second of 30 ms telemetry frames (33 frames), one noise byte in between
+        self.telemetry_stream = bytearray(b"\x55")
+        for i in range(33):
+            frame = TELEMETRY_FRAME.pack(
+                rng.randrange(20, 90), rng.randrange(1000, 2600), rng.randrange(5000), i, rng.randrange(600), 0
+            )[:-1]
+            self.telemetry_stream += frame + bytes([crc8(frame)])
+
+        self.flash_plan_cache = AM32FlashPlanCache(os.path.join(directory, "flash_plans"))
+
+    def create_connector(self, latency=0.0, flash_plan_cache=None, error_rate=0.0, ack_loss_rate=0.0):
+        fake_esc = AM32FakeESC(latency=latency, error_rate=error_rate, ack_loss_rate=ack_loss_rate, seed=RANDOM_SEED)
+        connector = AM32Connector(serial_port_instance=fake_esc, wait_after_write=E2E_WAIT_AFTER_WRITE)
+        connector.flash_plan_cache = flash_plan_cache
+        fake_esc.set_eeprom(self.eeprom_bytes, connector.eeprom_address)
+        return connector
+
+
+def bench_crc16_chunk(context):
+    AM32Connector.crc16(context.chunk)
+
+
+def bench_cmd_set_address(context):
+    context.frame_connector._cmd_set_address(0x1234)
+
+
+def bench_append_crc_chunk(context):
+    context.frame_connector._send_buffer = context.chunk
+    context.frame_connector._append_crc()
+
+
+def bench_eeprom_construct_default(context):
+    AM32eeprom()
+
+
+def bench_eeprom_construct_from_bytes(context):
+    AM32eeprom(eeprom_bytearray=context.eeprom_bytes)
+
+
+def bench_eeprom_get_set(context):
+    eeprom = context.eeprom
+    for byte_number in range(17, 47):
+        eeprom[byte_number] = eeprom[byte_number]
+
+
+def bench_eeprom_serialize(context):
+    context.eeprom.get_eeprom_bytearray()
+
+
+def bench_eeprom_bulk_audit_10k(context):
+    codec = context.eeprom_codec
+    records = codec.decode(context.eeprom_dump)
+    codec.scale(records)
+    codec.get_out_of_range(records)
+    codec.diff(records)
+
+
+def bench_read_eeprom_e2e(context):
+    if context.e2e_connector.cmd_read_eeprom() == -1:
+        raise ConnectionError("eeprom read failed")
+
+
+def bench_telemetry_decode_1s(context):
+    decoder = AM32TelemetryDecoder()
+    statistics = AM32TelemetryStatistics(window=256)
+    for frame in decoder.feed(context.telemetry_stream):
+        statistics.add(frame)
+
+
+def make_flash_plan_compile(name):
+    def bench_flash_plan_compile(context):
+        AM32FlashPlan(AM32FlashPlan.compile(context.frame_connector, context.firmware_files[name])).close()
+    return bench_flash_plan_compile
+
+
+def make_flash_plan_cached(name):
+    def bench_flash_plan_cached(context):
+        context.flash_plan_cache.get_plan(context.frame_connector, context.firmware_files[name]).close()
+    return bench_flash_plan_cached
+
+
+def make_write_firmware_e2e(name, cached=False, connector_name=None):
+    def bench_write_firmware_e2e(context):
+        if connector_name is not None:
+            connector = getattr(context, connector_name)
+        else:
+            connector = context.e2e_cached_connector if cached else context.e2e_connector
+        # erase the image area, a broken write must not pass with the flash of the previous run
+        image = context.firmware_images[name]
+        start_address = AM32Connector.FLASH_START_ADDRESS
+        fake_esc = connector.serial_port
+        fake_esc.flash[start_address:start_address + len(image)] = b"\xff" * len(image)
+        connector.write_firmware(context.firmware_files[name])
+        if fake_esc.flash[start_address:start_address + len(image)] != image:
+            raise ConnectionError("flash content does not match the image")
+    return bench_write_firmware_e2e
+
+
+# name, function, minimum iterations per sample
+BENCHMARKS = [
+    ("crc16_chunk128", bench_crc16_chunk, 200),
+    ("cmd_set_address", bench_cmd_set_address, 2000),
+    ("append_crc_chunk128", bench_append_crc_chunk, 200),
+] + [
+    ("flash_plan_compile_%s" % name, make_flash_plan_compile(name), 1) for name in FIRMWARE_SIZES
+] + [
+    ("flash_plan_cached_%s" % name, make_flash_plan_cached(name), 20) for name in FIRMWARE_SIZES
+] + [
+    ("eeprom_construct_default", bench_eeprom_construct_default, 2000),
+    ("eeprom_construct_from_bytes", bench_eeprom_construct_from_bytes, 2000),
+    ("eeprom_get_set", bench_eeprom_get_set, 500),
+    ("eeprom_serialize", bench_eeprom_serialize, 5000),
+    ("eeprom_bulk_audit_10k", bench_eeprom_bulk_audit_10k, 5),
+    ("telemetry_decode_1s", bench_telemetry_decode_1s, 100),
+    ("read_eeprom_e2e", bench_read_eeprom_e2e, 5),
+    ("write_firmware_e2e_4k", make_write_firmware_e2e("4k"), 1),
+    ("write_firmware_e2e_28k", make_write_firmware_e2e("28k"), 1),
+    ("write_firmware_e2e_28k_cached", make_write_firmware_e2e("28k", cached=True), 1),
+    ("write_firmware_e2e_28k_noisy", make_write_firmware_e2e("28k", connector_name="e2e_noisy_connector"), 1),
+    ("write_firmware_e2e_28k_lost_ack", make_write_firmware_e2e("28k", connector_name="e2e_lost_ack_connector"), 1),
+]
+
+
+def run_benchmark(function, context, iterations, samples):
+    """
+    Runs at least 'iterations' calls per sample, more if a sample would be shorter than MIN_SAMPLE_TIME
+    :return: fastest seconds per iteration over all samples, the minimum is the least noisy estimate
+    """
+    results = []
+    # the connector prints progress, keep the cost of it but not the output
+    with open(os.devnull, mode="w") as devnull, contextlib.redirect_stdout(devnull):
+        start_time = time.perf_counter()
+        function(context)       # warm up and calibrate
+        single_time = time.perf_counter() - start_time
+        if single_time > 0:
+            iterations = max(iterations, int(MIN_SAMPLE_TIME / single_time))
+
+        for sample in range(samples):
+            start_time = time.perf_counter()
+            for iteration in range(iterations):
+                function(context)
+            results.append((time.perf_counter() - start_time) / iterations)
+    return min(results)
+
+
+def get_host():
+    """:return: identifies the machine and interpreter, results of different hosts are not comparable"""
+    return "%s %s %s %s" % (
+        platform.node(), platform.machine(), platform.python_implementation(), platform.python_version()
+    )
+
+
+def load_baseline():
+    """:return: (host the baseline was measured on, {benchmark name: seconds})"""
+    if not os.path.isfile(BASELINE_FILE):
+        return None, {}
+    with open(BASELINE_FILE) as baseline_file:
+        baseline = json.load(baseline_file)
+    return baseline.get("host"), baseline.get("results", {})
+
+
+def save_baseline(host, results):
+    with open(BASELINE_FILE, mode="w") as baseline_file:
+        json.dump({"host": host, "results": results}, baseline_file, indent=4, sort_keys=True)
+        baseline_file.write("\n")
+
+
+def format_time(seconds):
+    if seconds < 1e-3:
+        return "%8.2f us" % (seconds * 1e6)
+    if seconds < 1:
+        return "%8.2f ms" % (seconds * 1e3)
+    return "%8.2f s " % seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AM32 connector / eeprom benchmarks")
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as new baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown against the baseline, 0.25 = 25%%")
+    parser.add_argument("--samples", type=int, default=7, help="samples per benchmark, the fastest is used")
+    parser.add_argument("--latency", type=float, default=E2E_LATENCY,
+                        help="reply latency of the fake ESC for end to end benchmarks in seconds")
+    parser.add_argument("--filter", default="", help="only run benchmarks containing this text")
+    args = parser.parse_args()
+
+    host = get_host()
+    baseline_host, baseline = load_baseline()
+    if baseline and baseline_host != host:
+        print("baseline was measured on another host (%s), regressions are not fatal" % baseline_host)
+    results = {}
+    regressions = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        context = BenchmarkContext(directory)
+        context.frame_connector = context.create_connector()
+        context.e2e_connector = context.create_connector(latency=args.latency)
+        context.e2e_cached_connector = context.create_connector(
+            latency=args.latency, flash_plan_cache=context.flash_plan_cache
+        )
+        context.e2e_noisy_connector = context.create_connector(
+            latency=args.latency, flash_plan_cache=context.flash_plan_cache, error_rate=NOISY_ERROR_RATE
+        )
+        context.e2e_lost_ack_connector = context.create_connector(
+            latency=args.latency, flash_plan_cache=context.flash_plan_cache, ack_loss_rate=LOST_ACK_RATE
+        )
+        context.eeprom = AM32eeprom(eeprom_bytearray=context.eeprom_bytes)
+        try:
+            context.eeprom_codec = AM32eepromCodec()
+        except ImportError as e:
+            print("skipping bulk eeprom benchmarks: %s" % str(e))
+            context.eeprom_codec = None
+
+        for name, function, iterations in BENCHMARKS:
+            if args.filter not in name:
+                continue
+            if name.startswith("eeprom_bulk") and context.eeprom_codec is None:
+                continue
+
+            result = run_benchmark(function, context, iterations, args.samples)
+            results[name] = result
+
+            line = "%-32s %s" % (name, format_time(result))
+            if name in baseline:
+                change = (result - baseline[name]) / baseline[name]
+                line += "   baseline %s  %+6.1f%%" % (format_time(baseline[name]), change * 100)
+                if change > args.threshold:
+                    line += "  REGRESSION"
+                    regressions.append(name)
+            print(line)
+
+    if args.update_baseline:
+        if not args.filter:
+            # full run, drop results of removed benchmarks
+            baseline = {}
+        elif baseline_host != host:
+            # never mix results of two hosts
+            baseline = {}
+        baseline.update(results)
+        save_baseline(host, baseline)
+        print("baseline written to %s" % BASELINE_FILE)
+        return 0
+
+    if regressions:
+        print("%d regression(s) above %d%%: %s" % (len(regressions), args.threshold * 100, ", ".join(regressions)))
+        if baseline_host == host:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+#!python3
+# -*- coding: utf-8 -*-
+
+"""
+    In-process emulation of the AM32 bootloader behind a serial port.
+    Implements the serial port calls AM32Connector uses (write, read_all, flushInput)
+    and answers like a real ESC, with a configurable reply latency.
+
+    Copyright Julian Wingert, 2023, Licensed under the GPL V3
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from AM32Connector import AM32Connector
+
+
+__author__ = 'Julian Wingert'
+__copyright__ = 'Copyright 2023, AM32 ESC Setup Tool'
+__license__ = 'GPL V3'
+__version__ = '0.1'
+__maintainer__ = 'Julian Wingert'
+__status__ = 'testing'
+
+
+class AM32FakeESC:
+    """
+    Fake serial port with an emulated AM32 bootloader.
+
+    latency:    seconds until a reply becomes readable after a write
+    baudrate:   if set, the reply arrives byte by byte at this rate (10 bits per byte) after the latency,
+                read_all() only returns the bytes arrived so far, like a real serial port
+    echo:       one wire adapters read back what they send, the fake does the same
+    error_rate: probability of a set address, payload or write flash command being NACKed (line noise),
+                a NACKed command has no effect
+    ack_loss_rate: probability of the ACK of an executed write flash command getting lost,
+                the flash is written but the host only reads the echo
+    """
+
+    ACK = 0x30
+    BAD_CRC = 0xC2
+    FLASH_SIZE = 0x20000
+
+    def __init__(self, esc_type=AM32Connector.ESC_TYPE_F0ESC_1KB_PAGE, latency=0.0, echo=True, error_rate=0.0,
+                 ack_loss_rate=0.0, seed=0, baudrate=None):
+        self.esc_type = esc_type
+        self.latency = latency
+        self.byte_time = 10 / baudrate if baudrate else 0.0
+        self.echo = echo
+        self.error_rate = error_rate
+        self.ack_loss_rate = ack_loss_rate
+        self._random = random.Random(seed)
+        self.memory_divider_required_four = esc_type == AM32Connector.ESC_TYPE_G071ESC_2KB_PAGE
+
+        self.flash = bytearray([0xff] * self.FLASH_SIZE)
+        self.address = 0
+        self._expected_payload_size = None
+        self._buffer = bytearray()
+
+        self._reply = bytearray()
+        self._reply_ready_time = 0.0
+        self._reply_position = 0        # bytes of the reply read or flushed
+
+        # statistics
+        self.frames_received = 0
+        self.bytes_written = 0
+        self.flash_writes = 0
+        self.errors_injected = 0
+        self.acks_lost = 0
+
+    def set_eeprom(self, eeprom_bytearray, eeprom_address):
+        address = eeprom_address * 4 if self.memory_divider_required_four else eeprom_address
+        self.flash[address:address + len(eeprom_bytearray)] = eeprom_bytearray
+
+    @staticmethod
+    def _crc_ok(frame):
+        crc_high_byte, crc_low_byte = AM32Connector.crc16(frame[:-2])
+        return frame[-2] == crc_low_byte and frame[-1] == crc_high_byte
+
+    def _inject_error(self):
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors_injected += 1
+            return True
+        return False
+
+    def _flash_address(self):
+        return self.address * 4 if self.memory_divider_required_four else self.address
+
+    def _answer(self, frame, reply):
+        self._reply = bytearray(frame) if self.echo else bytearray()
+        self._reply += reply
+        self._reply_ready_time = time.monotonic() + self.latency
+        self._reply_position = 0
+
+    def write(self, data):
+        frame = bytes(data)
+        self.frames_received += 1
+        self.bytes_written += len(frame)
+
+        if self._expected_payload_size is not None:
+            # payload after a set buffer size command
+            expected_size = self._expected_payload_size
+            self._expected_payload_size = None
+            if len(frame) == expected_size + 2 and self._crc_ok(frame) and not self._inject_error():
+                self._buffer = bytearray(frame[:-2])
+                self._answer(frame, bytes([self.ACK]))
+            else:
+                self._answer(frame, bytes([self.BAD_CRC]))
+            return len(frame)
+
+        if len(frame) > 4 and frame[:4] == b"\x00\x00\x00\x00":
+            # init string, reply with bootloader info, the ESC type is the fifth last byte
+            self._answer(frame, b"471" + bytes([0x64, self.esc_type, 0x06, 0x06, 0x01, self.ACK]))
+            return len(frame)
+
+        if not self._crc_ok(frame):
+            self._answer(frame, bytes([self.BAD_CRC]))
+            return len(frame)
+
+        command = frame[0]
+        if command in (0xff, 0x01) and self._inject_error():
+            self._answer(frame, bytes([self.BAD_CRC]))
+            return len(frame)
+
+        if command == 0xff:
+            self.address = (frame[2] << 8) | frame[3]
+            self._answer(frame, bytes([self.ACK]))
+        elif command == 0xfe:
+            self._expected_payload_size = frame[3] if frame[3] != 0 else 256
+            # no reply, the ESC waits for the payload
+            self._answer(frame, b"")
+        elif command == 0x01:
+            address = self._flash_address()
+            self.flash[address:address + len(self._buffer)] = self._buffer
+            self.flash_writes += 1
+            if self.ack_loss_rate and self._random.random() < self.ack_loss_rate:
+                self.acks_lost += 1
+                self._answer(frame, b"")
+            else:
+                self._answer(frame, bytes([self.ACK]))
+        elif command == 0x03:
+            size = frame[1] if frame[1] != 0 else 256
+            address = self._flash_address()
+            data = bytes(self.flash[address:address + size])
+            crc_high_byte, crc_low_byte = AM32Connector.crc16(data)
+            self._answer(frame, data + bytes([crc_low_byte, crc_high_byte, self.ACK]))
+        else:
+            self._answer(frame, bytes([self.BAD_CRC]))
+        return len(frame)
+
+    def _get_arrived(self):
+        """:return: number of reply bytes received by now"""
+        elapsed = time.monotonic() - self._reply_ready_time
+        if elapsed < 0:
+            return 0
+        if not self.byte_time:
+            return len(self._reply)
+        return min(len(self._reply), int(elapsed / self.byte_time) + 1)
+
+    def read_all(self):
+        arrived = self._get_arrived()
+        reply = bytes(self._reply[self._reply_position:arrived])
+        self._reply_position = max(self._reply_position, arrived)
+        return reply
+
+    def flushInput(self):
+        self._reply_position = max(self._reply_position, self._get_arrived())
+
+    def close(self):
+        pass
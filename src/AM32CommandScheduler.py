@@ -0,0 +1,232 @@
+#!python3
+# -*- coding: utf-8 -*-
+
+"""
+    Per connection command scheduler.
+    A single owner thread is the only one talking to the AM32Connector and its serial port.
+    Commands are queued by priority, a firmware flash is split into one command per chunk,
+    so short eeprom reads and writes get in between two chunks instead of waiting for the flash.
+
+    Copyright Julian Wingert, 2023, Licensed under the GPL V3
+"""
+
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+__author__ = 'Julian Wingert'
+__copyright__ = 'Copyright 2023, AM32 ESC Setup Tool'
+__license__ = 'GPL V3'
+__version__ = '0.1'
+__maintainer__ = 'Julian Wingert'
+__status__ = 'testing'
+
+
+class _Command:
+    def __init__(self, function, args, future, deadline):
+        self.function = function
+        self.args = args
+        self.future = future
+        self.deadline = deadline
+
+
+class AM32CommandScheduler(threading.Thread):
+    """
+    Owner thread of one AM32Connector.
+
+    All methods return a concurrent.futures.Future. A command that could not be started before its
+    deadline fails with TimeoutError, a started command always runs to the end, a frame sequence
+    is never interrupted. Lower priority numbers run first, equal priorities in submit order.
+    """
+
+    PRIORITY_EEPROM_READ = 10
+    PRIORITY_EEPROM_WRITE = 20
+    PRIORITY_PROBE = 30
+    PRIORITY_FLASH = 50
+
+    # seconds a command may wait in the queue
+    DEFAULT_DEADLINES = {
+        PRIORITY_EEPROM_READ: 10,
+        PRIORITY_EEPROM_WRITE: 20,
+        PRIORITY_PROBE: 10,
+        PRIORITY_FLASH: 60,
+    }
+
+    _STOP_PRIORITY = -1
+
+    def __init__(self, connector, keepalive_interval=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.connector = connector
+        self.keepalive_interval = keepalive_interval
+        self.link_alive = True
+
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._stopping = False
+        # flashes run one after the other, the chunks of two images must not interleave
+        self._flash_lock = threading.Lock()
+        self._flash_running = False
+        self._pending_flashes = []
+
+    def submit(self, priority, function, *args, deadline=None):
+        """
+        Queues function(connector, *args)
+        :param deadline: seconds from now the command has to be started in, default by priority
+        """
+        if self._stopping:
+            raise ConnectionAbortedError("command scheduler stopped")
+        if deadline is None:
+            deadline = self.DEFAULT_DEADLINES.get(priority, 10)
+
+        future = Future()
+        self._put(priority, _Command(function, args, future, time.monotonic() + deadline))
+        return future
+
+    def _put(self, priority, command):
+        self._queue.put((priority, next(self._sequence), command))
+
+    def read_eeprom(self, deadline=None):
+        return self.submit(self.PRIORITY_EEPROM_READ, self._read_eeprom, deadline=deadline)
+
+    def write_eeprom(self, eeprom_bytearray, deadline=None):
+        return self.submit(
+            self.PRIORITY_EEPROM_WRITE, lambda connector: connector.write_eeprom(eeprom_bytearray), deadline=deadline
+        )
+
+    def probe(self, deadline=None):
+        return self.submit(self.PRIORITY_PROBE, lambda connector: connector.cmd_probe(), deadline=deadline)
+
+    def write_firmware(self, filename, progress_callback=None, chunk_deadline=None):
+        """
+        Flashes filename, every chunk is its own command, the next chunk is queued when the last one is written.
+        With a flash_delta on the connector only the changed chunks are written.
+        A flash submitted while another one is running starts when that one is done.
+        :param progress_callback: optional callable(chunks_written, num_chunks), called from the owner thread
+        :return: Future, result is the number of chunks written
+        """
+        if self._stopping:
+            raise ConnectionAbortedError("command scheduler stopped")
+        if chunk_deadline is None:
+            chunk_deadline = self.DEFAULT_DEADLINES[self.PRIORITY_FLASH]
+        flash_future = Future()
+        flash_future.set_running_or_notify_cancel()
+        flash_future.add_done_callback(self._flash_done)
+
+        with self._flash_lock:
+            self._pending_flashes.append((filename, progress_callback, chunk_deadline, flash_future))
+            if self._flash_running:
+                return flash_future
+            self._flash_running = True
+        self._start_next_flash()
+        return flash_future
+
+    def _flash_done(self, flash_future):
+        with self._flash_lock:
+            if not self._pending_flashes:
+                self._flash_running = False
+                return
+        self._start_next_flash()
+
+    def _start_next_flash(self):
+        with self._flash_lock:
+            filename, progress_callback, chunk_deadline, flash_future = self._pending_flashes.pop(0)
+        try:
+            self._start_flash(filename, progress_callback, chunk_deadline, flash_future)
+        except ConnectionAbortedError as e:
+            flash_future.set_exception(e)
+
+    def _start_flash(self, filename, progress_callback, chunk_deadline, flash_future):
+
+        def load_plan(connector):
+            plan, chunks = connector.start_flash(filename)
+            if chunks:
+                queue_chunk(plan, chunks, 0)
+            else:
+                finish(connector, plan, chunks)
+
+        def queue_chunk(plan, chunks, index):
+            command = _Command(write_chunk, (plan, chunks, index), Future(), time.monotonic() + chunk_deadline)
+            command.future.add_done_callback(lambda future: check_chunk(plan, future))
+            self._put(self.PRIORITY_FLASH, command)
+
+        def write_chunk(connector, plan, chunks, index):
+            connector.write_plan_chunk(chunks[index])
+            if progress_callback is not None:
+                progress_callback(connector.chunks_written, len(chunks))
+            if index + 1 < len(chunks):
+                queue_chunk(plan, chunks, index + 1)
+            else:
+                finish(connector, plan, chunks)
+
+        def finish(connector, plan, chunks):
+            connector.finish_flash(plan, filename, completed=True)
+            flash_future.set_result(len(chunks))
+
+        def check_chunk(plan, future):
+            if future.exception() is not None and not flash_future.done():
+                self.connector.finish_flash(plan, filename, completed=False)
+                flash_future.set_exception(future.exception())
+
+        def check_load_plan(future):
+            if future.exception() is not None:
+                flash_future.set_exception(future.exception())
+
+        load_future = self.submit(self.PRIORITY_FLASH, load_plan, deadline=chunk_deadline)
+        load_future.add_done_callback(check_load_plan)
+
+    @staticmethod
+    def _read_eeprom(connector):
+        eeprom_data = connector.cmd_read_eeprom()
+        if eeprom_data == -1:
+            raise ConnectionError("ESC communication problem! eeprom read failed")
+        return eeprom_data
+
+    def stop(self, wait=True):
+        """Finishes the running command, all queued commands fail with ConnectionAbortedError"""
+        self._stopping = True
+        self._put(self._STOP_PRIORITY, None)
+        if wait and self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def _fail_pending(self):
+        while True:
+            try:
+                priority, sequence, command = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if command is not None and command.future.set_running_or_notify_cancel():
+                command.future.set_exception(ConnectionAbortedError("command scheduler stopped"))
+
+    def _keepalive(self):
+        try:
+            self.link_alive = bool(self.connector.cmd_probe())
+        except Exception as e:
+            print("command scheduler: keepalive failed: %s" % str(e))
+            self.link_alive = False
+
+    def run(self):
+        while True:
+            try:
+                priority, sequence, command = self._queue.get(timeout=self.keepalive_interval)
+            except queue.Empty:
+                # idle, keep the bootloader connection alive
+                self._keepalive()
+                continue
+
+            if command is None:
+                self._fail_pending()
+                return
+
+            if not command.future.set_running_or_notify_cancel():
+                continue
+            if time.monotonic() > command.deadline:
+                command.future.set_exception(TimeoutError("command deadline missed"))
+                continue
+
+            try:
+                command.future.set_result(command.function(self.connector, *command.args))
+            except Exception as e:
+                command.future.set_exception(e)
@@ -0,0 +1,132 @@
+#!python3
+# -*- coding: utf-8 -*-
+
+"""
+    Background worker for the ESC connect flow.
+    Opens the serial port, detects the ESC and reads the initial eeprom without blocking the GUI
+
+    Copyright Julian Wingert, 2023, Licensed under the GPL V3
+"""
+
+import threading
+
+from AM32eeprom import AM32eeprom
+from AM32Connector import AM32Connector
+
+
+__author__ = 'Julian Wingert'
+__copyright__ = 'Copyright 2023, AM32 ESC Setup Tool'
+__license__ = 'GPL V3'
+__version__ = '0.1'
+__maintainer__ = 'Julian Wingert'
+__status__ = 'testing'
+
+
+class AM32ConnectWorker(threading.Thread):
+    """
+    Runs open port -> ESC detection -> eeprom read in a thread.
+
+    All callbacks are called from the worker thread, the caller has to marshal them
+    to its own (GUI) thread, e.g. with kivy.clock.mainthread.
+
+    on_status(text)                         progress messages
+    on_result(serial_port, esc, eeprom)     connect done, eeprom is an AM32eeprom instance
+    on_error(text)                          connect failed, timed out or was cancelled
+    """
+
+    STATUS_OPENING = "opening %s"
+    STATUS_DETECTING = "detecting ESC on %s"
+    STATUS_READING_EEPROM = "reading eeprom"
+    STATUS_WRITING_DEFAULT_EEPROM = "eeprom version mismatch, writing default eeprom"
+
+    def __init__(self, serial_device_name, open_port, on_status=None, on_result=None, on_error=None, timeout=15):
+        threading.Thread.__init__(self, daemon=True)
+        self.serial_device_name = serial_device_name
+        self.open_port = open_port      # callable(serial_device_name) -> serial port instance or None
+        self.on_status = on_status
+        self.on_result = on_result
+        self.on_error = on_error
+        self.timeout = timeout
+
+        self.abort_event = threading.Event()
+        self.timed_out = False
+        self._timer = None
+
+    def cancel(self):
+        """Aborts the connect flow, the worker reports 'cancelled' via on_error"""
+        self.abort_event.set()
+
+    def _on_timeout(self):
+        self.timed_out = True
+        self.abort_event.set()
+
+    def _status(self, text):
+        print("connect worker: %s" % text)
+        if self.on_status is not None:
+            self.on_status(text)
+
+    def run(self):
+        self._timer = threading.Timer(self.timeout, self._on_timeout)
+        self._timer.daemon = True
+        self._timer.start()
+
+        serial_port = None
+        try:
+            self._status(self.STATUS_OPENING % self.serial_device_name)
+            serial_port = self.open_port(self.serial_device_name)
+            if serial_port is None:
+                raise ConnectionError("ERR: TIMEOUT (%s)" % self.serial_device_name)
+
+            self._status(self.STATUS_DETECTING % self.serial_device_name)
+            esc = AM32Connector(serial_port_instance=serial_port, abort_event=self.abort_event)
+            if esc.esc_type is None:
+                raise ConnectionError("ERR: unknown ESC (%s)" % self.serial_device_name)
+
+            self._status(self.STATUS_READING_EEPROM)
+            eeprom = self._read_eeprom(esc)
+
+            # done, from now on the connector must not be aborted by this worker anymore
+            self._timer.cancel()
+            esc.abort_event = None
+            if self.abort_event.is_set():
+                raise ConnectionAbortedError("ESC communication aborted!")
+        except Exception as e:
+            self._timer.cancel()
+            self._close_port(serial_port)
+            if self.timed_out:
+                message = "ERR: TIMEOUT (%s)" % self.serial_device_name
+            elif isinstance(e, ConnectionAbortedError):
+                message = "connect cancelled (%s)" % self.serial_device_name
+            else:
+                message = str(e)
+            print("connect worker: %s" % message)
+            if self.on_error is not None:
+                self.on_error(message)
+            return
+
+        if self.on_result is not None:
+            self.on_result(serial_port, esc, eeprom)
+
+    def _read_eeprom(self, esc):
+        eeprom_data = esc.cmd_read_eeprom()
+        if eeprom_data == -1:
+            raise ConnectionError("ERR: eeprom read failed (%s)" % self.serial_device_name)
+
+        # check eeprom for correct version
+        default_eeprom = AM32eeprom()
+        if default_eeprom[1] == eeprom_data[1]:
+            return AM32eeprom(eeprom_bytearray=eeprom_data)
+
+        # eeprom version did not match, load default eeprom and write it
+        self._status(self.STATUS_WRITING_DEFAULT_EEPROM)
+        esc.write_eeprom(default_eeprom.get_eeprom_bytearray())
+        return default_eeprom
+
+    @staticmethod
+    def _close_port(serial_port):
+        if serial_port is None:
+            return
+        try:
+            serial_port.close()
+        except Exception as e:
+            print("Exception: %s" % str(e))
@@ -9,6 +9,11 @@
 """
 
 import time
+import uuid
+
+from AM32RetryPolicy import (
+    AM32RetryPolicy, STAGE_ADDRESS, STAGE_BUFFER_SIZE, STAGE_PAYLOAD, STAGE_WRITE, STAGES
+)
 
 
 __author__ = 'Julian Wingert'
@@ -46,10 +51,18 @@ class AM32Connector:
     CHUNK_SIZE = 128
     EEPROM_SIZE = 48
 
-    def __init__(self, serial_port_instance=None, baudrate=19200, wait_after_write=0.025):
+    def __init__(self, serial_port_instance=None, baudrate=19200, wait_after_write=0.025, abort_event=None,
+                 retry_policy=None):
         self.baudrate = baudrate
         self.wait_after_write = wait_after_write
         self.serial_port = serial_port_instance     # serial_device_name of serial.Serial()
+        # optional threading.Event, if set all pending ESC communication is aborted
+        self.abort_event = abort_event
+        if retry_policy is None:
+            retry_policy = AM32RetryPolicy(total_retries=self.ESC_SEND_RETRIES)
+        self.retry_policy = retry_policy
+        # failures per write stage since connecting, see AM32RetryPolicy
+        self.stage_failures = dict.fromkeys(STAGES, 0)
 
         self.last_result = None
         self.ack_received = False
@@ -58,20 +71,67 @@ class AM32Connector:
         self.eeprom_address = None
         self.memory_divider_required_four = None
         self._send_buffer = bytearray()
-        self._flash_file_chunks = []
         self._flash_file_num_chunks = 0
-        self._flash_file_name = ""
         self.chunks_written = 0
+        # optional AM32FlashPlanCache, compiled flash plans of an image are reused across flashes
+        self.flash_plan_cache = None
+        # optional AM32FlashDelta, only the pages differing from the installed image are written
+        self.flash_delta = None
+        # (major, minor) and ESC name as reported by the eeprom, None if unknown
+        self.installed_firmware_version = None
+        self.esc_name = None
+        # identifies the running flash in the flash_delta markers
+        self._flash_id = None
 
         self._init_esc()
 
-    def _load_bin_to_chunks(self, filename):
-        self._flash_file_chunks = []
-        self._flash_file_num_chunks = 0
-        with open(filename, mode="rb") as bin_file:
-            while buf := bin_file.read(self.CHUNK_SIZE):
-                self._flash_file_chunks.append(buf)
-                self._flash_file_num_chunks += 1
+    def get_flash_plan(self, filename):
+        """:return: AM32FlashPlan for filename and the connected ESC, close it after use"""
+        from AM32FlashPlan import AM32FlashPlan
+
+        if self.flash_plan_cache is not None:
+            return self.flash_plan_cache.get_plan(self, filename)
+        return AM32FlashPlan(AM32FlashPlan.compile(self, filename))
+
+    def get_flash_chunks(self, plan, filename):
+        """
+        :return: the chunks of plan that have to be written, all of them unless flash_delta predicts
+                 the changed ones and a readback of an unchanged chunk confirms the prediction
+        """
+        if self.flash_delta is None or self.installed_firmware_version is None:
+            return plan.chunks
+
+        prediction = self.flash_delta.predict(plan, filename, self.esc_name, self.installed_firmware_version)
+        if prediction is None:
+            return plan.chunks
+
+        chunk_indices, sample_index = prediction
+        if sample_index is not None:
+            address, buffer_size, address_frame, buffer_size_frame, payload_frame = plan.chunks[sample_index]
+            try:
+                read_result = self._read_direct(buffer_size, address)
+            except ConnectionError as e:
+                print("delta readback failed: %s" % str(e))
+                read_result = -1
+            if read_result == -1 or bytes(read_result) != bytes(payload_frame[:-2]):
+                print("installed firmware does not match version %d.%02d, writing everything" % tuple(
+                    self.installed_firmware_version
+                ))
+                return plan.chunks
+
+        print("delta flash: %d of %d chunks changed" % (len(chunk_indices), plan.num_chunks))
+        return [plan.chunks[index] for index in chunk_indices]
+
+    def record_flashed_image(self, filename):
+        """Called after filename has been written completely, the installed version is now the image's"""
+        from AM32FirmwareLibrary import AM32FirmwareLibrary
+
+        version = AM32FirmwareLibrary.extract_metadata(filename)["version"]
+        if version is not None:
+            version = tuple(version)
+        if self.flash_delta is not None:
+            self.flash_delta.record(self.esc_type, self.esc_name, version, filename, self._flash_id)
+        self.installed_firmware_version = version
 
     def write_eeprom(self, eeprom_bytearray):
         if self.esc_type is None:
@@ -83,50 +143,80 @@ class AM32Connector:
                 "eeprom size mismatch, %s expected, %s received" % (self.EEPROM_SIZE, len(eeprom_bytearray))
             )
 
-        tries = 0
-        while True:
-            res = self._send_direct(eeprom_bytearray, self.eeprom_address, send_eeprom=True)
-            if res == len(eeprom_bytearray):
-                print("eeprom written successfully")
-                return res
-            else:
-                print("Retrying!")
+        res = self._send_direct(eeprom_bytearray, self.eeprom_address, send_eeprom=True)
+        if res != len(eeprom_bytearray):
+            print("Max retries reached writing eeprom!")
+            raise ConnectionError("ESC communication problem!")
+        print("eeprom written successfully")
+        return res
 
-            tries += 1
-            if tries > self.ESC_SEND_RETRIES:
-                print("Max retries reached writing eeprom!")
-                raise ConnectionError("ESC communication problem!")
-
-    def write_firmware(self, filename):
+    def write_firmware(self, filename, progress_callback=None):
+        """
+        Writes the firmware file to the ESC
+        :param filename: firmware .bin file
+        :param progress_callback: optional callable(chunks_written, num_chunks), called after every chunk
+        """
+        plan, chunks = self.start_flash(filename)
+        start_time = int(time.time())
+        completed = False
+
+        try:
+            for chunk in chunks:
+                self.write_plan_chunk(chunk)
+
+                print("%03ds: %04d/%04d" % (
+                    int(time.time() - start_time), self.chunks_written, self._flash_file_num_chunks
+                ))
+                if progress_callback is not None:
+                    progress_callback(self.chunks_written, self._flash_file_num_chunks)
+            completed = True
+        finally:
+            self.finish_flash(plan, filename, completed)
+
+    def start_flash(self, filename):
+        """
+        First step of every flash (write_firmware, AM32CommandScheduler), write the chunks with
+        write_plan_chunk and call finish_flash afterwards, also if the flash failed
+        :return: (plan, chunks to write)
+        """
         if self.esc_type is None:
             raise FileNotFoundError("No ESC connected!")
 
-        # load FW file to chunks
-        self._load_bin_to_chunks(filename)
-        start_time = int(time.time())
-        flash_address = self.FLASH_START_ADDRESS
-        self.chunks_written = 0
-
-        for buffer in self._flash_file_chunks:
-
-            tries = 0
-            while True:
-                if self.memory_divider_required_four:
-                    res = self._send_direct(bytearray(buffer), flash_address >> 2)
-                else:
-                    res = self._send_direct(bytearray(buffer), flash_address)
-                if res == len(buffer):
-                    break
-                else:
-                    print("Retrying!")
+        # all frames of the image, compiled once per image and ESC type
+        plan = self.get_flash_plan(filename)
+        try:
+            chunks = self.get_flash_chunks(plan, filename)
+        except Exception:
+            plan.close()
+            raise
 
-                tries += 1
-                if tries > self.ESC_SEND_RETRIES:
-                    raise ConnectionError("ESC communication problem!")
+        self._flash_file_num_chunks = len(chunks)
+        self.chunks_written = 0
+        # a partly written image matches no version, also not after reconnecting
+        self.installed_firmware_version = None
+        self._flash_id = uuid.uuid4().hex
+        if self.flash_delta is not None:
+            self.flash_delta.set_flash_in_progress(self.esc_type, self.esc_name, filename, self._flash_id)
+        return plan, chunks
+
+    def finish_flash(self, plan, filename, completed):
+        """Releases the plan, a completed flash is recorded as the installed image"""
+        plan.close()
+        if completed:
+            self.record_flashed_image(filename)
+
+    def write_plan_chunk(self, chunk):
+        """
+        Writes one chunk of an AM32FlashPlan, retried as the retry_policy allows
+        :return: number of bytes written or exception
+        """
+        address, buffer_size, address_frame, buffer_size_frame, payload_frame = chunk
 
-            flash_address += len(buffer)
-            self.chunks_written += 1
-            print("%03ds: %04d/%04d" % (int(time.time() - start_time), self.chunks_written, self._flash_file_num_chunks))
+        res = self._send_frames(address_frame, buffer_size_frame, payload_frame, buffer_size)
+        if res != buffer_size:
+            raise ConnectionError("ESC communication problem!")
+        self.chunks_written += 1
+        return res
 
     def get_flash_done_percentage(self):
         if self.chunks_written == 0:
@@ -134,16 +224,37 @@ class AM32Connector:
         return int((self.chunks_written / self._flash_file_num_chunks) * 100)
 
     def cmd_read_eeprom(self):
-        return self._read_direct(self.EEPROM_SIZE, self.eeprom_address, read_eeprom=True)
+        eeprom_data = self._read_direct(self.EEPROM_SIZE, self.eeprom_address, read_eeprom=True)
+        if eeprom_data != -1:
+            # eeprom bytes 3 and 4, firmware_version_major / minor, bytes 5-16 the ESC name
+            self.esc_name = self.get_esc_name(eeprom_data)
+            if self.flash_delta is not None and self.flash_delta.is_flash_in_progress(self.esc_type, self.esc_name):
+                # the eeprom does not know about a partly written image
+                self.installed_firmware_version = None
+            else:
+                self.installed_firmware_version = (eeprom_data[3], eeprom_data[4])
+        return eeprom_data
 
-    def _receive_ack(self):
+    @staticmethod
+    def get_esc_name(eeprom_data):
+        return bytes(eeprom_data[5:17]).rstrip(b"\x00\xff ").decode("ascii", errors="replace")
+
+    def cmd_probe(self):
+        """Checks that the bootloader still answers, without changing anything on the ESC"""
+        self._cmd_set_address(self.eeprom_address)
+        return self._receive_ack()
+
+    def _receive_ack(self, sent_length=None):
         """
         This method tries to receive an ack byte from the serial port
         Serial data is stored in class var self.last_result
+        :param sent_length: length of the frame sent, a longer reply (echo + answer) without ACK is a NACK,
+                            no need to wait for the timeout then
         :return: True if received, False if not
         """
         self.ack_received = False
         for tries in range(50):
+            self._check_abort()
             time.sleep(self.wait_after_write)
             self.last_result = self.serial_port.read_all()
             # print("res: ", self.last_result)
@@ -152,12 +263,21 @@ class AM32Connector:
                     # print("Command ACK")
                     self.ack_received = True
                     return True
+                elif sent_length is not None and len(self.last_result) > sent_length:
+                    print("ERROR! Command NACK 0x%02x!" % self.last_result[-1])
+                    self.last_result = None
+                    return False
                 else:
                     self.last_result = None
 
         print("ERROR! Command NACK!")
         return False
 
+    def _check_abort(self):
+        """Raises ConnectionAbortedError if the abort event has been set by another thread"""
+        if self.abort_event is not None and self.abort_event.is_set():
+            raise ConnectionAbortedError("ESC communication aborted!")
+
     def _init_esc(self, retries=5):
         # send init string to ESC, resetting it
         tries = 0;
@@ -215,40 +335,39 @@ class AM32Connector:
         crc_low_byte = crc16 & 0xff
         return crc_high_byte, crc_low_byte
 
-    def _append_crc(self):
-        """Appends CRC to the actual send_buffer of the class"""
-        crc_high_byte, crc_low_byte = self.crc16(self._send_buffer)
+    @classmethod
+    def build_frame(cls, data):
+        """:return: new bytearray of data with the CRC appended, data itself is not modified"""
+        crc_high_byte, crc_low_byte = cls.crc16(data)
 
-        # prevent reference to preserve the original data in self._send_buffer
-        # this basically creates a copy. Otherwise an object referred to by self._send_buffer
-        # would get modified
-        self._send_buffer = bytearray(self._send_buffer)
+        frame = bytearray(data)
+        frame.append(crc_low_byte)
+        frame.append(crc_high_byte)
+        return frame
 
-        self._send_buffer.append(crc_low_byte)
-        self._send_buffer.append(crc_high_byte)
+    @classmethod
+    def build_set_address_frame(cls, address):
+        return cls.build_frame(bytes([0xff, 0x00, (address >> 8) & 0xff, address & 0xff]))
 
-    def _cmd_set_address(self, address):
-        self._send_buffer = bytearray()
-        self._send_buffer.append(0xff)  # set address
-        self._send_buffer.append(0x00)
-        self._send_buffer.append(((address >> 8) & 0xff))
-        self._send_buffer.append((address & 0xff))
+    @classmethod
+    def build_set_buffer_size_frame(cls, buffer_size):
+        if buffer_size == 256:
+            buffer_size = 0
 
-        self._append_crc()
+        return cls.build_frame(bytes([0xfe, 0x00, 0x00, buffer_size]))
 
-        self.serial_port.write(self._send_buffer)
+    def _append_crc(self):
+        """Appends CRC to the actual send_buffer of the class"""
+        # build_frame creates a copy, an object referred to by self._send_buffer is not modified
+        self._send_buffer = self.build_frame(self._send_buffer)
 
-    def _cmd_set_buffer_size(self, buffer_size):
-        if buffer_size == 256:
-            buffer_size = 0
+    def _cmd_set_address(self, address):
+        self._send_buffer = self.build_set_address_frame(address)
 
-        self._send_buffer = bytearray()
-        self._send_buffer.append(0xfe)
-        self._send_buffer.append(0x00)
-        self._send_buffer.append(0x00)
-        self._send_buffer.append(buffer_size)
+        self.serial_port.write(self._send_buffer)
 
-        self._append_crc()
+    def _cmd_set_buffer_size(self, buffer_size):
+        self._send_buffer = self.build_set_buffer_size_frame(buffer_size)
 
         self.serial_port.write(self._send_buffer)
 
@@ -273,27 +392,65 @@ class AM32Connector:
         self.serial_port.write(self._send_buffer)
 
     def _send_direct(self, send_buffer, address, send_eeprom=False):
-        buffer_size = len(send_buffer)
-        # print(buffer_size)
+        return self._send_frames(
+            self.build_set_address_frame(address),
+            self.build_set_buffer_size_frame(len(send_buffer)),
+            self.build_frame(send_buffer),
+            len(send_buffer),
+            send_eeprom=send_eeprom
+        )
+
+    def _send_frames(self, address_frame, buffer_size_frame, payload_frame, buffer_size, send_eeprom=False):
+        """
+        Sends prebuilt frames (see build_*_frame or AM32FlashPlan) and writes them to flash.
+        A failed stage is resumed as the retry_policy allows, after a backoff and draining the input.
+        :return: buffer_size if written, -1 if the retries are used up
+        """
+        policy = self.retry_policy
+        stage_failures = dict.fromkeys(STAGES, 0)
+        retries = 0
+        stage = STAGE_ADDRESS
+        while True:
+            failed_stage = self._send_stages(
+                stage, address_frame, buffer_size_frame, payload_frame, send_eeprom=send_eeprom
+            )
+            if failed_stage is None:
+                return buffer_size
 
-        self._cmd_set_address(address)
-        if not self._receive_ack():
-            return -1
-        # print("set address")
+            stage_failures[failed_stage] += 1
+            self.stage_failures[failed_stage] += 1
+            if retries >= policy.total_retries:
+                return -1
 
-        self._cmd_set_buffer_size(buffer_size)
-        time.sleep(self.wait_after_write)
-        self.serial_port.flushInput()
-        # print("set buffer size")
+            stage = policy.get_resume_stage(failed_stage, stage_failures[failed_stage])
+            print("Retrying from %s, %s failed" % (stage, failed_stage))
+            self._resync(policy.get_backoff(retries))
+            retries += 1
 
-        self._send_buffer = send_buffer
-        self._append_crc()              # appends crc to self._send_buffer....
-        self.serial_port.write(self._send_buffer)
-        if send_eeprom:
-            time.sleep(self.wait_after_write*2)
-        if not self._receive_ack():
-            return -1
-        # print("sent buffer")
+    def _send_stages(self, stage, address_frame, buffer_size_frame, payload_frame, send_eeprom=False):
+        """
+        Sends the write stages starting with stage
+        :return: None if all stages were ACKed, else the stage that failed
+        """
+        if stage == STAGE_ADDRESS:
+            self.serial_port.write(address_frame)
+            if not self._receive_ack(len(address_frame)):
+                return STAGE_ADDRESS
+            # print("set address")
+            stage = STAGE_BUFFER_SIZE
+
+        if stage == STAGE_BUFFER_SIZE:
+            self.serial_port.write(buffer_size_frame)
+            time.sleep(self.wait_after_write)
+            self.serial_port.flushInput()
+            # print("set buffer size")
+
+            self.serial_port.write(payload_frame)
+            if send_eeprom:
+                time.sleep(self.wait_after_write*2)
+            if not self._receive_ack(len(payload_frame)):
+                return STAGE_PAYLOAD
+            # print("sent buffer")
 
         self._cmd_write_flash()
         time.sleep(self.wait_after_write)
@@ -301,11 +458,17 @@ class AM32Connector:
         if send_eeprom:
             time.sleep(self.wait_after_write*2)
 
-        if not self._receive_ack():
-            return -1
+        if not self._receive_ack(len(self._send_buffer)):
+            return STAGE_WRITE
         # print("sent write flash")
 
-        return buffer_size
+        return None
+
+    def _resync(self, backoff):
+        """Waits for late replies of a failed stage and drops them, they must not ACK the next command"""
+        self._check_abort()
+        time.sleep(backoff)
+        self.serial_port.flushInput()
 
     def _read_direct(self, buffer_size, address, read_eeprom=False):
         """
@@ -326,19 +489,40 @@ class AM32Connector:
         if read_eeprom:
             time.sleep(self.wait_after_write*2)
 
-        if not self._receive_ack():
-            return -1
+        return self._receive_data(buffer_size)
 
-        # buffer consists of the above command, the result, two bytes crc and the ack byte
-        # what we want is the buffer size from minus three bytes (2x crc plus ack)
-        read_result = self.last_result[-(buffer_size+3):-3]
-        crc_result = self.last_result[-4:]
+    def _receive_data(self, buffer_size):
+        """
+        Collects the reply of a read flash command until it is complete, at 19200 baud a 128 byte read
+        takes longer than one poll. The reply is the echo of the command, the data, two bytes crc and the ack byte.
+        Serial data is stored in class var self.last_result
+        :param buffer_size: size of the data
+        :return: data read, -1 if the reply is incomplete or a NACK, exception on a crc mismatch
+        """
+        reply = bytearray()
+        for tries in range(50):
+            self._check_abort()
+            time.sleep(self.wait_after_write)
+            data = self.serial_port.read_all()
+            if data:
+                reply += data
+                if len(reply) >= buffer_size + 3 and reply[-1] == self.ACK and self._check_read_crc(reply, buffer_size):
+                    self.last_result = bytes(reply)
+                    return self.last_result[-(buffer_size + 3):-3]
+            elif reply:
+                # nothing followed, the reply is complete but not valid
+                self.last_result = bytes(reply)
+                if len(reply) >= buffer_size + 3 and reply[-1] == self.ACK:
+                    raise ConnectionError("ESC communication problem! CRC mismatch!")
+                print("ERROR! Command NACK 0x%02x!" % reply[-1])
+                return -1
 
-        crc_high_byte, crc_low_byte = self.crc16(read_result)
+        print("ERROR! Command NACK!")
+        return -1
 
-        if int(crc_result[1]) == crc_low_byte and int(crc_result[2]) == crc_high_byte:
-            return read_result
-        else:
-            raise ConnectionError("ESC communication problem! CRC mismatch!")
+    def _check_read_crc(self, reply, buffer_size):
+        # data, crc low byte, crc high byte, ack
+        crc_high_byte, crc_low_byte = self.crc16(reply[-(buffer_size + 3):-3])
+        return reply[-3] == crc_low_byte and reply[-2] == crc_high_byte
 
 
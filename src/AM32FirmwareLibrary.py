@@ -0,0 +1,198 @@
+#!python3
+# -*- coding: utf-8 -*-
+
+"""
+    Local firmware library.
+    Scans firmware directories for .bin images, extracts metadata (target names, MCU family,
+    version, size, hash) and keeps a persisted index, so lookups by ESC type are instant.
+
+    Copyright Julian Wingert, 2023, Licensed under the GPL V3
+"""
+
+import hashlib
+import json
+import os
+import re
+
+from AM32Connector import AM32Connector
+
+
+__author__ = 'Julian Wingert'
+__copyright__ = 'Copyright 2023, AM32 ESC Setup Tool'
+__license__ = 'GPL V3'
+__version__ = '0.1'
+__maintainer__ = 'Julian Wingert'
+__status__ = 'testing'
+
+
+def get_cache_path():
+    """Default directory for indexes and caches of the setup tool"""
+    return os.path.join(os.path.expanduser('~'), '.am32setuptool')
+
+
+def get_file_sha256(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, mode="rb") as bin_file:
+        while buf := bin_file.read(1024 * 1024):
+            sha256.update(buf)
+    return sha256.hexdigest()
+
+
+class AM32FirmwareLibrary:
+    """
+    Index of the firmware images in the configured directories.
+
+    Every entry is a dict: path, name, size, mtime_ns, sha256, esc_type, targets, version
+    The index is invalidated per file by size / mtime, an unchanged hash keeps the old metadata.
+    """
+
+    INDEX_VERSION = 2
+    FIRMWARE_FILE_EXTENSION = ".bin"
+    MIN_STRING_LENGTH = 4
+
+    # MCU names found in AM32 target names and file names, mapped to the bootloader ESC type
+    MCU_ESC_TYPES = [
+        ("G071", AM32Connector.ESC_TYPE_G071ESC_2KB_PAGE),
+        ("F051", AM32Connector.ESC_TYPE_F0ESC_1KB_PAGE),
+        ("F031", AM32Connector.ESC_TYPE_F0ESC_1KB_PAGE),
+        ("F303", AM32Connector.ESC_TYPE_F3ESC_2KB_PAGE),
+    ]
+    ESC_TYPE_NAMES = {
+        AM32Connector.ESC_TYPE_G071ESC_2KB_PAGE: "G071",
+        AM32Connector.ESC_TYPE_F0ESC_1KB_PAGE: "F0",
+        AM32Connector.ESC_TYPE_F3ESC_2KB_PAGE: "F3",
+    }
+
+    _printable_strings = re.compile(rb"[\x20-\x7e]{%d,}" % MIN_STRING_LENGTH)
+    _target_name = re.compile(r"[A-Z][A-Z0-9]+(?:_[A-Z0-9]{2,})+")
+    # only "." separates major and minor, "_" separates the parts of the name (AM32_HGLRC_F45_2.05)
+    _file_name_version = re.compile(r"(?:^|[._ -])[vV]?(\d+)\.(\d+)$")
+    _string_version = re.compile(r"(?:^|[^0-9.])[vV]?(\d{1,2})\.(\d{1,2})(?=[^0-9.]|$)")
+
+    def __init__(self, directories, index_filename=None):
+        self.directories = list(directories)
+        if index_filename is None:
+            index_filename = os.path.join(get_cache_path(), "firmware_index.json")
+        self.index_filename = index_filename
+        self.entries = {}
+        self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_filename) as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return
+        if index.get("version") == self.INDEX_VERSION:
+            self.entries = {entry["path"]: entry for entry in index["entries"]}
+
+    def _save_index(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_filename)), exist_ok=True)
+        temp_filename = self.index_filename + ".tmp"
+        with open(temp_filename, mode="w") as index_file:
+            json.dump({"version": self.INDEX_VERSION, "entries": list(self.entries.values())}, index_file)
+        os.replace(temp_filename, self.index_filename)
+
+    def _find_firmware_files(self):
+        for directory in self.directories:
+            for root, dirs, files in os.walk(directory):
+                for name in files:
+                    if name.lower().endswith(self.FIRMWARE_FILE_EXTENSION):
+                        yield os.path.normpath(os.path.join(root, name))
+
+    def scan(self):
+        """
+        Updates the index, only new or changed files are read
+        :return: number of files (re)read
+        """
+        entries = {}
+        files_read = 0
+        known_hashes = {entry["sha256"]: entry for entry in self.entries.values()}
+
+        for path in self._find_firmware_files():
+            try:
+                stat = os.stat(path)
+                entry = self.entries.get(path)
+                if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                    entries[path] = entry
+                    continue
+
+                files_read += 1
+                sha256 = get_file_sha256(path)
+                if sha256 in known_hashes:
+                    # same image, e.g. touched or copied, reuse the extracted metadata
+                    entry = dict(known_hashes[sha256])
+                else:
+                    entry = self.extract_metadata(path)
+                    entry["sha256"] = sha256
+                entry.update(path=path, name=os.path.basename(path), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+                entries[path] = entry
+            except OSError as e:
+                print("firmware library: skipping %s: %s" % (path, str(e)))
+
+        changed = files_read > 0 or entries.keys() != self.entries.keys()
+        self.entries = entries
+        if changed:
+            self._save_index()
+        return files_read
+
+    @classmethod
+    def extract_metadata(cls, path):
+        """Reads the image and extracts target names, MCU family (ESC type) and version"""
+        with open(path, mode="rb") as bin_file:
+            data = bin_file.read()
+
+        strings = [match.decode("ascii") for match in cls._printable_strings.findall(data)]
+        name = os.path.splitext(os.path.basename(path))[0]
+
+        targets = []
+        for text in strings + [name.upper()]:
+            for target in cls._target_name.findall(text):
+                if target not in targets:
+                    targets.append(target)
+
+        esc_type = None
+        for text in [name.upper()] + targets + strings:
+            for mcu_name, mcu_esc_type in cls.MCU_ESC_TYPES:
+                if mcu_name in text:
+                    esc_type = mcu_esc_type
+                    break
+            if esc_type is not None:
+                break
+
+        # the version is usually the end of the file name (AM32_TARGET_F051_1.94.bin), else look in the strings
+        version = None
+        match = cls._file_name_version.search(name)
+        if match is None:
+            for text in strings:
+                if match := cls._string_version.search(text):
+                    break
+        if match is not None:
+            version = [int(match.group(1)), int(match.group(2))]
+
+        return {"esc_type": esc_type, "targets": targets, "version": version}
+
+    def lookup(self, esc_type):
+        """:return: entries built for esc_type, newest version first"""
+        entries = [entry for entry in self.entries.values() if entry["esc_type"] == esc_type]
+        entries.sort(key=lambda entry: entry["version"] or [0, 0], reverse=True)
+        return entries
+
+    def get_entry(self, path):
+        return self.entries.get(path)
+
+    def get_filechooser_filter(self, esc_type):
+        """
+        :return: callable(folder, filename) for kivy FileChooser.filters, hides images known to be
+                 built for a different ESC type, unknown files stay visible
+        """
+        def firmware_filter(folder, filename):
+            if not filename.lower().endswith(self.FIRMWARE_FILE_EXTENSION):
+                return False
+            entry = self.entries.get(os.path.normpath(filename))
+            return entry is None or entry["esc_type"] is None or entry["esc_type"] == esc_type
+        return firmware_filter
+
+    @classmethod
+    def get_esc_type_name(cls, esc_type):
+        return cls.ESC_TYPE_NAMES.get(esc_type, "unknown")
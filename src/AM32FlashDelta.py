@@ -0,0 +1,200 @@
+#!python3
+# -*- coding: utf-8 -*-
+
+"""
+    Version aware delta flashing.
+    Keeps page hashes of every flashed image, indexed by ESC type, ESC name and firmware version.
+    The eeprom tells the installed firmware version at connect time, so the pages that differ
+    between the installed and the new image are known without reading the flash back,
+    only those pages are written.
+
+    Works on flash pages, not chunks: the bootloader erases a page when its first chunk is written,
+    so a changed page is always written completely.
+
+    Copyright Julian Wingert, 2023, Licensed under the GPL V3
+"""
+
+import hashlib
+import json
+import os
+
+from AM32Connector import AM32Connector
+from AM32FirmwareLibrary import get_cache_path
+
+
+__author__ = 'Julian Wingert'
+__copyright__ = 'Copyright 2023, AM32 ESC Setup Tool'
+__license__ = 'GPL V3'
+__version__ = '0.1'
+__maintainer__ = 'Julian Wingert'
+__status__ = 'testing'
+
+
+class AM32FlashDelta:
+    """
+    Index of flashed images: "<esc type>_<esc name>_<major>.<minor>" -> {sha256, size, page_size, pages}
+    pages is a list of the (shortened) sha256 of every flash page of the image.
+    The ESC type is only the MCU family, the ESC name (eeprom bytes 5-16) tells targets of the same
+    family apart. Only the last image flashed per ESC type, name and version is kept.
+
+    installed: "<esc type>_<esc name>" -> {version, sha256} of the last completed flash.
+    The eeprom reports the old version until the new firmware has run once, so its version is only
+    trusted if it is the version of the last completed image, e.g. not after flashing 1.01 over 1.00
+    and connecting again before the ESC has booted.
+
+    flashing: "<esc type>_<esc name>" -> {flash id: file name} of the flashes started but not completed.
+    The eeprom does not know about a partly written image, as long as a marker is set the
+    installed image is unknown. ESCs of the same type and name share the markers, a completed flash
+    clears the markers of other flashes but its version is not trusted then, the next flash writes everything.
+    The index is reloaded before every use, the flash worker process writes it too.
+    """
+
+    INDEX_VERSION = 4
+    PAGE_SIZES = {
+        AM32Connector.ESC_TYPE_F0ESC_1KB_PAGE: 1024,
+        AM32Connector.ESC_TYPE_G071ESC_2KB_PAGE: 2048,
+        AM32Connector.ESC_TYPE_F3ESC_2KB_PAGE: 2048,
+    }
+    PAGE_HASH_LENGTH = 16
+
+    def __init__(self, index_filename=None):
+        if index_filename is None:
+            index_filename = os.path.join(get_cache_path(), "flash_delta.json")
+        self.index_filename = index_filename
+        self.entries = {}
+        self.installed = {}
+        self.flashing = {}
+        self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_filename) as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return
+        if index.get("version") == self.INDEX_VERSION:
+            self.entries = index["entries"]
+            self.installed = index["installed"]
+            self.flashing = index["flashing"]
+
+    def _save_index(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_filename)), exist_ok=True)
+        temp_filename = self.index_filename + ".tmp"
+        with open(temp_filename, mode="w") as index_file:
+            json.dump({
+                "version": self.INDEX_VERSION, "entries": self.entries, "installed": self.installed,
+                "flashing": self.flashing,
+            }, index_file)
+        os.replace(temp_filename, self.index_filename)
+
+    @staticmethod
+    def _get_esc_key(esc_type, esc_name):
+        return "%02x_%s" % (esc_type, esc_name or "")
+
+    def set_flash_in_progress(self, esc_type, esc_name, filename, flash_id):
+        """Call before the first chunk is written, record() with the same flash_id clears it"""
+        self._load_index()
+        self.flashing.setdefault(self._get_esc_key(esc_type, esc_name), {})[flash_id] = filename
+        try:
+            self._save_index()
+        except OSError as e:
+            print("flash delta: %s" % str(e))
+
+    def is_flash_in_progress(self, esc_type, esc_name):
+        """:return: True if the last flash of the ESC has not been completed"""
+        self._load_index()
+        return bool(self.flashing.get(self._get_esc_key(esc_type, esc_name)))
+
+    @staticmethod
+    def _get_key(esc_type, esc_name, version):
+        return "%02x_%s_%d.%02d" % (esc_type, esc_name or "", version[0], version[1])
+
+    @classmethod
+    def get_page_hashes(cls, image, page_size):
+        image_view = memoryview(image)
+        return [
+            hashlib.sha256(image_view[offset:offset + page_size]).hexdigest()[:cls.PAGE_HASH_LENGTH]
+            for offset in range(0, len(image), page_size)
+        ]
+
+    @staticmethod
+    def _read_image(filename):
+        with open(filename, mode="rb") as bin_file:
+            return bin_file.read()
+
+    def record(self, esc_type, esc_name, version, filename, flash_id):
+        """
+        Remembers filename as the image of version (major, minor) for esc_type and esc_name,
+        called after a completed flash, clears the flash in progress markers
+        """
+        self._load_index()
+        esc_key = self._get_esc_key(esc_type, esc_name)
+        markers = self.flashing.pop(esc_key, {})
+        markers.pop(flash_id, None)
+        if markers:
+            # another ESC of this type and name may hold a partly written image and report this version
+            print("flash delta: %d unfinished flash(es) of %s, the next flash writes everything" % (
+                len(markers), esc_key
+            ))
+            version = None
+
+        image = self._read_image(filename)
+        sha256 = hashlib.sha256(image).hexdigest()
+        self.installed[esc_key] = {"version": list(version) if version is not None else None, "sha256": sha256}
+
+        page_size = self.PAGE_SIZES.get(esc_type)
+        if page_size is not None and version is not None:
+            self.entries[self._get_key(esc_type, esc_name, version)] = {
+                "sha256": sha256,
+                "size": len(image),
+                "page_size": page_size,
+                "pages": self.get_page_hashes(image, page_size),
+            }
+        try:
+            self._save_index()
+        except OSError as e:
+            print("flash delta: %s" % str(e))
+
+    def predict(self, plan, filename, esc_name, installed_version):
+        """
+        Predicts the chunks of plan that differ from the installed image
+        :param plan: AM32FlashPlan of filename
+        :param esc_name: ESC name from the eeprom
+        :param installed_version: (major, minor) from the eeprom
+        :return: (indices of the chunks to write, index of an unchanged chunk to confirm by readback)
+                 or None if the installed image is unknown and everything has to be written
+        """
+        if self.is_flash_in_progress(plan.esc_type, esc_name):
+            return None
+        installed = self.installed.get(self._get_esc_key(plan.esc_type, esc_name))
+        if installed is None or installed["version"] != list(installed_version):
+            # the eeprom version is not the one of the last completed image
+            return None
+        entry = self.entries.get(self._get_key(plan.esc_type, esc_name, installed_version))
+        page_size = self.PAGE_SIZES.get(plan.esc_type)
+        if entry is None or entry["sha256"] != installed["sha256"] or entry["page_size"] != page_size:
+            return None
+
+        image = self._read_image(filename)
+        installed_pages = entry["pages"]
+        new_pages = self.get_page_hashes(image, page_size)
+        changed_pages = {
+            page for page, page_hash in enumerate(new_pages)
+            if page >= len(installed_pages) or installed_pages[page] != page_hash
+        }
+
+        chunk_indices = []
+        unchanged_indices = []
+        offset = 0
+        for index, chunk in enumerate(plan.chunks):
+            if offset // page_size in changed_pages:
+                chunk_indices.append(index)
+            else:
+                unchanged_indices.append(index)
+            offset += chunk[1]
+
+        if not unchanged_indices:
+            return chunk_indices, None
+        # a different sample per image, repeated delta flashes do not always confirm the same chunk
+        sample_index = unchanged_indices[int(hashlib.sha256(image).hexdigest()[:8], 16) % len(unchanged_indices)]
+        return chunk_indices, sample_index
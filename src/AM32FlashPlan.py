@@ -0,0 +1,186 @@
+#!python3
+# -*- coding: utf-8 -*-
+
+"""
+    Compiled flash plans.
+    A flash plan holds every frame needed to write a firmware image (set address, set buffer size
+    and payload + CRC per chunk), built once per (image hash, ESC type, chunk size).
+    Plans are cached on disk and memory mapped, the frames are memoryview slices of the mapping,
+    so a repeated flash of the same image does no per chunk CRC or copy work on the host.
+
+    Copyright Julian Wingert, 2023, Licensed under the GPL V3
+"""
+
+import mmap
+import os
+import struct
+import zlib
+
+from AM32FirmwareLibrary import get_cache_path, get_file_sha256
+
+
+__author__ = 'Julian Wingert'
+__copyright__ = 'Copyright 2023, AM32 ESC Setup Tool'
+__license__ = 'GPL V3'
+__version__ = '0.1'
+__maintainer__ = 'Julian Wingert'
+__status__ = 'testing'
+
+
+PLAN_MAGIC = b"AM32PLN\x02"
+PLAN_HEADER = struct.Struct("<8sBHII")    # magic, esc type, chunk size, number of chunks, CRC32 of the rest
+PLAN_CHUNK = struct.Struct("<III")        # address as sent to the ESC, offset of the frames, payload size
+PLAN_FILE_EXTENSION = ".am32plan"
+COMMAND_FRAME_SIZE = 6                    # set address and set buffer size frames, 4 bytes + CRC
+
+
+class AM32FlashPlan:
+    """
+    Parsed flash plan on top of a bytes like buffer or a mmap.
+
+    chunks: list of (address, payload_size, address_frame, buffer_size_frame, payload_frame),
+            the frames are memoryview slices of the buffer, ready to be written to the serial port
+    """
+
+    def __init__(self, buffer, filename=None):
+        self.filename = filename
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+
+        self.chunks = []
+        try:
+            self._parse()
+        except ValueError:
+            # also releases a mapping, a broken cache file can be replaced
+            self.close()
+            raise
+
+    def _parse(self):
+        if len(self._view) < PLAN_HEADER.size:
+            raise ValueError("%s is not an AM32 flash plan" % self.filename)
+        magic, self.esc_type, self.chunk_size, self.num_chunks, crc = PLAN_HEADER.unpack_from(self._view, 0)
+        table_end = PLAN_HEADER.size + self.num_chunks * PLAN_CHUNK.size
+        if magic != PLAN_MAGIC or table_end > len(self._view):
+            raise ValueError("%s is not an AM32 flash plan" % self.filename)
+        if zlib.crc32(self._view[PLAN_HEADER.size:]) != crc:
+            raise ValueError("%s is corrupt, CRC mismatch" % self.filename)
+
+        for address, frames_offset, payload_size in PLAN_CHUNK.iter_unpack(self._view[PLAN_HEADER.size:table_end]):
+            buffer_size_offset = frames_offset + COMMAND_FRAME_SIZE
+            payload_offset = buffer_size_offset + COMMAND_FRAME_SIZE
+            if payload_offset + payload_size + 2 > len(self._view):
+                # a truncated plan must fail here, not after the first chunks erased their pages
+                raise ValueError("%s is truncated" % self.filename)
+            self.chunks.append((
+                address,
+                payload_size,
+                self._view[frames_offset:buffer_size_offset],
+                self._view[buffer_size_offset:payload_offset],
+                self._view[payload_offset:payload_offset + payload_size + 2],
+            ))
+
+    @classmethod
+    def compile(cls, connector, filename):
+        """
+        Builds the plan for writing filename with the connector's ESC type and chunk size
+        :return: plan as bytes, load it with AM32FlashPlan(plan_bytes)
+        """
+        chunk_size = connector.CHUNK_SIZE
+        table = bytearray()
+        frames = bytearray()
+
+        with open(filename, mode="rb") as bin_file:
+            image = bin_file.read()
+        num_chunks = (len(image) + chunk_size - 1) // chunk_size
+        frames_start = PLAN_HEADER.size + num_chunks * PLAN_CHUNK.size
+
+        image_view = memoryview(image)
+        flash_address = connector.FLASH_START_ADDRESS
+        for offset in range(0, len(image), chunk_size):
+            payload = image_view[offset:offset + chunk_size]
+            address = flash_address >> 2 if connector.memory_divider_required_four else flash_address
+
+            table += PLAN_CHUNK.pack(address, frames_start + len(frames), len(payload))
+            frames += connector.build_set_address_frame(address)
+            frames += connector.build_set_buffer_size_frame(len(payload))
+            frames += connector.build_frame(payload)
+
+            flash_address += len(payload)
+
+        body = table + frames
+        return PLAN_HEADER.pack(PLAN_MAGIC, connector.esc_type, chunk_size, num_chunks, zlib.crc32(body)) + body
+
+    @classmethod
+    def load(cls, filename):
+        """Memory maps a plan file"""
+        with open(filename, mode="rb") as plan_file:
+            plan_mmap = mmap.mmap(plan_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(plan_mmap, filename=filename)
+
+    def close(self):
+        """Releases the memoryviews and the mapping, the frames must not be used afterwards"""
+        for chunk in self.chunks:
+            for frame in chunk[2:]:
+                frame.release()
+        self.chunks = []
+        self._view.release()
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+
+class AM32FlashPlanCache:
+    """
+    Disk cache of compiled flash plans with LRU eviction.
+    The file modification time is the last use, the least recently used plans are removed
+    when more than max_plans are stored.
+    """
+
+    def __init__(self, cache_dir=None, max_plans=16):
+        if cache_dir is None:
+            cache_dir = os.path.join(get_cache_path(), "flash_plans")
+        self.cache_dir = cache_dir
+        self.max_plans = max_plans
+
+    def _get_plan_filename(self, sha256, esc_type, chunk_size):
+        return os.path.join(self.cache_dir, "%s_%02x_%d%s" % (sha256, esc_type, chunk_size, PLAN_FILE_EXTENSION))
+
+    def get_plan(self, connector, filename):
+        """:return: AM32FlashPlan for flashing filename with connector, compiled only on a cache miss"""
+        plan_filename = self._get_plan_filename(get_file_sha256(filename), connector.esc_type, connector.CHUNK_SIZE)
+
+        if os.path.isfile(plan_filename):
+            try:
+                plan = AM32FlashPlan.load(plan_filename)
+                os.utime(plan_filename)
+                return plan
+            except (OSError, ValueError) as e:
+                print("flash plan cache: recompiling %s: %s" % (plan_filename, str(e)))
+
+        plan_bytes = AM32FlashPlan.compile(connector, filename)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_filename = plan_filename + ".tmp"
+            with open(temp_filename, mode="wb") as plan_file:
+                plan_file.write(plan_bytes)
+            os.replace(temp_filename, plan_filename)
+            self._evict()
+            return AM32FlashPlan.load(plan_filename)
+        except OSError as e:
+            # no usable cache directory, flash from memory
+            print("flash plan cache: %s" % str(e))
+            return AM32FlashPlan(plan_bytes)
+
+    def _evict(self):
+        plan_files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(PLAN_FILE_EXTENSION):
+                path = os.path.join(self.cache_dir, name)
+                plan_files.append((os.stat(path).st_mtime_ns, path))
+        plan_files.sort(reverse=True)
+
+        for mtime_ns, path in plan_files[self.max_plans:]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                # e.g. mapped by a running flash on windows, next eviction gets it
+                print("flash plan cache: %s" % str(e))
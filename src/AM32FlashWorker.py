@@ -0,0 +1,271 @@
+#!python3
+# -*- coding: utf-8 -*-
+
+"""
+    Out-of-process flashing worker.
+    A separate interpreter owns the serial port and the AM32Connector, so GUI rendering and
+    the timing critical flash loop do not share the GIL. Commands and events are JSON lines
+    over the worker's stdin / stdout.
+
+    The worker never aborts a running flash: if the GUI dies, the current command is finished,
+    then the worker notices the closed stdin, closes the port and exits.
+
+    Copyright Julian Wingert, 2023, Licensed under the GPL V3
+"""
+
+import json
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+
+
+__author__ = 'Julian Wingert'
+__copyright__ = 'Copyright 2023, AM32 ESC Setup Tool'
+__license__ = 'GPL V3'
+__version__ = '0.1'
+__maintainer__ = 'Julian Wingert'
+__status__ = 'testing'
+
+
+# frozen builds (pyinstaller) can not run this file, main.py starts the worker when given this argument
+FLASH_WORKER_ARGUMENT = "--am32-flash-worker"
+
+EVENT_STATUS = "status"
+EVENT_PROGRESS = "progress"
+EVENT_RESULT = "result"
+EVENT_ERROR = "error"
+EVENT_EXIT = "exit"
+
+
+class AM32FlashWorker:
+    """
+    GUI side of the flashing worker. All command methods return immediately,
+    results arrive as events, fetch them with get_events() e.g. from a kivy Clock callback.
+
+    events are dicts: {"event": "status"|"progress"|"result"|"error"|"exit", ...}
+    """
+
+    def __init__(self):
+        self._process = None
+        self._events = queue.Queue()
+        self._reader_thread = None
+
+    @staticmethod
+    def _get_worker_command():
+        if getattr(sys, 'frozen', False):
+            return [sys.executable, FLASH_WORKER_ARGUMENT]
+        return [sys.executable, os.path.abspath(__file__)]
+
+    def start(self):
+        kwargs = {}
+        if os.name == 'nt':
+            # no console of its own and not attached to the GUI's, closing the console window
+            # of the console build must not kill a running flash
+            kwargs["creationflags"] = subprocess.CREATE_NO_WINDOW | subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            # own session, a ctrl-c or a crash of the GUI must not kill a running flash
+            kwargs["start_new_session"] = True
+
+        self._process = subprocess.Popen(
+            self._get_worker_command(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            **kwargs
+        )
+        self._reader_thread = threading.Thread(target=self._read_events, daemon=True)
+        self._reader_thread.start()
+
+    def _read_events(self):
+        for line in self._process.stdout:
+            try:
+                self._events.put(json.loads(line))
+            except ValueError:
+                print("flash worker: invalid event %r" % line)
+        self._events.put({"event": EVENT_EXIT, "returncode": self._process.wait()})
+
+    def _send(self, command, **kwargs):
+        kwargs["command"] = command
+        self._process.stdin.write(json.dumps(kwargs) + "\n")
+        self._process.stdin.flush()
+
+    def open_port(self, serial_device_name, baudrate=19200):
+        self._send("open_port", serial_device_name=serial_device_name, baudrate=baudrate)
+
+    def read_eeprom(self):
+        self._send("read_eeprom")
+
+    def write_eeprom(self, eeprom_bytearray):
+        self._send("write_eeprom", eeprom=list(eeprom_bytearray))
+
+    def write_firmware(self, filename, plan_cache_dir=None, flash_delta_filename=None, installed_version=None,
+                       esc_name=None):
+        self._send("write_firmware", filename=filename, plan_cache_dir=plan_cache_dir,
+                   flash_delta_filename=flash_delta_filename, installed_version=installed_version, esc_name=esc_name)
+
+    def close_port(self):
+        self._send("close_port")
+
+    def shutdown(self):
+        """Lets the worker finish all queued commands, then exit"""
+        self._send("shutdown")
+        self._process.stdin.close()
+
+    def is_alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def get_events(self):
+        events = []
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except queue.Empty:
+                return events
+
+
+class _WorkerState:
+    """Worker process side, executes the commands read from stdin"""
+
+    def __init__(self, event_output):
+        self.event_output = event_output
+        self.gui_alive = True
+        self.serial_port = None
+        self.esc = None
+
+    def send_event(self, event, **kwargs):
+        if not self.gui_alive:
+            return
+        kwargs["event"] = event
+        try:
+            self.event_output.write(json.dumps(kwargs) + "\n")
+            self.event_output.flush()
+        except (OSError, ValueError):
+            # GUI is gone, keep working, a half flashed ESC is worse than a lost progress message
+            self.gui_alive = False
+
+    def cmd_open_port(self, serial_device_name, baudrate=19200):
+        from serial import Serial
+        from AM32Connector import AM32Connector
+        from AM32SerialCapture import SerialCapture, get_capture_filename
+
+        self.cmd_close_port()
+        self.send_event(EVENT_STATUS, text="opening %s" % serial_device_name)
+        self.serial_port = Serial(serial_device_name, baudrate, 8, 'N', 1, timeout=1)
+        capture_dir = os.environ.get("AM32_SERIAL_CAPTURE")
+        if capture_dir:
+            self.serial_port = SerialCapture(self.serial_port, get_capture_filename(capture_dir))
+        self.send_event(EVENT_STATUS, text="detecting ESC on %s" % serial_device_name)
+        self.esc = AM32Connector(serial_port_instance=self.serial_port, baudrate=baudrate)
+        if self.esc.esc_type is None:
+            raise ConnectionError("ERR: unknown ESC (%s)" % serial_device_name)
+        return self.esc.esc_type
+
+    def cmd_read_eeprom(self):
+        eeprom_data = self.esc.cmd_read_eeprom()
+        if eeprom_data == -1:
+            raise ConnectionError("ERR: eeprom read failed")
+        return list(eeprom_data)
+
+    def cmd_write_eeprom(self, eeprom):
+        return self.esc.write_eeprom(bytearray(eeprom))
+
+    def cmd_write_firmware(self, filename, plan_cache_dir=None, flash_delta_filename=None, installed_version=None,
+                           esc_name=None):
+        from AM32FlashDelta import AM32FlashDelta
+        from AM32FlashPlan import AM32FlashPlanCache
+
+        def progress(chunks_written, num_chunks):
+            self.send_event(EVENT_PROGRESS, chunks_written=chunks_written, num_chunks=num_chunks,
+                            percent=int((chunks_written / num_chunks) * 100))
+
+        if self.esc is None:
+            raise FileNotFoundError("No ESC connected!")
+        self.esc.flash_plan_cache = AM32FlashPlanCache(plan_cache_dir)
+        self.esc.flash_delta = AM32FlashDelta(flash_delta_filename)
+        if installed_version is not None:
+            self.esc.installed_firmware_version = tuple(installed_version)
+        self.esc.esc_name = esc_name
+        self.esc.write_firmware(filename, progress_callback=progress)
+        return self.esc.chunks_written
+
+    def cmd_close_port(self):
+        if self.serial_port is not None:
+            self.serial_port.close()
+        self.serial_port = None
+        self.esc = None
+
+    def execute(self, request):
+        command = request.pop("command", None)
+        handler = getattr(self, "cmd_%s" % command, None)
+        if handler is None:
+            self.send_event(EVENT_ERROR, command=command, text="unknown command")
+            return
+        try:
+            result = handler(**request)
+        except Exception as e:
+            print("flash worker: %s failed: %s" % (command, str(e)))
+            self.send_event(EVENT_ERROR, command=command, text=str(e))
+        else:
+            self.send_event(EVENT_RESULT, command=command, value=result)
+
+
+class _LogOutput:
+    """
+    stdout / stderr of the worker, the inherited stderr of the GUI may be a dead pipe or a closed tty.
+    A failing print must not stop a running flash, once writing failed the output is dropped.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        if self.stream is None:
+            return len(text)
+        try:
+            return self.stream.write(text)
+        except (OSError, ValueError):
+            self.stream = None
+            return len(text)
+
+    def flush(self):
+        if self.stream is None:
+            return
+        try:
+            self.stream.flush()
+        except (OSError, ValueError):
+            self.stream = None
+
+
+def worker_main():
+    """Entry point of the worker process"""
+    # the GUI's ctrl-c must not interrupt a flash
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # stdout belongs to the event stream, everything printed (e.g. by AM32Connector) goes to stderr
+    event_output = os.fdopen(os.dup(sys.stdout.fileno()), mode="w")
+    sys.stdout = sys.stderr = _LogOutput(sys.stderr)
+
+    state = _WorkerState(event_output)
+    try:
+        for line in sys.stdin:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                state.send_event(EVENT_ERROR, command=None, text="invalid command %r" % line)
+                continue
+            if request.get("command") == "shutdown":
+                break
+            state.execute(request)
+    finally:
+        # stdin closed (GUI gone) or shutdown, the last command has completed
+        state.cmd_close_port()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(worker_main())
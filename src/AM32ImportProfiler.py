@@ -0,0 +1,78 @@
+#!python3
+# -*- coding: utf-8 -*-
+
+"""
+    Import time profiler for the app startup.
+    Hooks __import__, measures every first import of a module and prints a report of the
+    slowest imports together with startup milestones (e.g. first frame).
+
+    Copyright Julian Wingert, 2023, Licensed under the GPL V3
+"""
+
+import builtins
+import sys
+import time
+
+
+__author__ = 'Julian Wingert'
+__copyright__ = 'Copyright 2023, AM32 ESC Setup Tool'
+__license__ = 'GPL V3'
+__version__ = '0.1'
+__maintainer__ = 'Julian Wingert'
+__status__ = 'testing'
+
+
+class AM32ImportProfiler:
+    """
+    records: (module name, cumulative seconds including nested imports, nesting depth, start offset)
+    marks: (label, seconds since install)
+    """
+
+    def __init__(self):
+        self.records = []
+        self.marks = []
+        self.start_time = None
+        self._depth = 0
+        self._original_import = None
+
+    def install(self):
+        self.start_time = time.perf_counter()
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level != 0 or name in sys.modules:
+            # already loaded or relative, nothing to measure
+            return self._original_import(name, globals, locals, fromlist, level)
+
+        start_time = time.perf_counter()
+        depth = self._depth
+        self._depth += 1
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            self._depth = depth
+            self.records.append((name, time.perf_counter() - start_time, depth, start_time - self.start_time))
+
+    def mark(self, label):
+        self.marks.append((label, time.perf_counter() - self.start_time))
+
+    def report(self, top=25):
+        print("---- import profile ----")
+        for label, offset in self.marks:
+            print("%8.1f ms  %s" % (offset * 1000, label))
+
+        top_level = [record for record in self.records if record[2] == 0]
+        print("top level imports: %d, %.1f ms" % (len(top_level), sum(record[1] for record in top_level) * 1000))
+        for name, elapsed, depth, offset in sorted(top_level, key=lambda record: record[1], reverse=True)[:top]:
+            print("%8.1f ms  %-40s at %8.1f ms" % (elapsed * 1000, name, offset * 1000))
+
+        print("slowest imports (cumulative):")
+        for name, elapsed, depth, offset in sorted(self.records, key=lambda record: record[1], reverse=True)[:top]:
+            print("%8.1f ms  %s%s" % (elapsed * 1000, "  " * depth, name))
+        print("------------------------")
@@ -0,0 +1,72 @@
+#!python3
+# -*- coding: utf-8 -*-
+
+"""
+    Retry policy for the four stages of a bootloader write (set address, set buffer size, payload, write flash).
+    Knows from which stage a failed write can be resumed and how long to back off before resuming.
+
+    Copyright Julian Wingert, 2023, Licensed under the GPL V3
+"""
+
+
+__author__ = 'Julian Wingert'
+__copyright__ = 'Copyright 2023, AM32 ESC Setup Tool'
+__license__ = 'GPL V3'
+__version__ = '0.1'
+__maintainer__ = 'Julian Wingert'
+__status__ = 'testing'
+
+
+STAGE_ADDRESS = "address"
+STAGE_BUFFER_SIZE = "buffer_size"
+STAGE_PAYLOAD = "payload"
+STAGE_WRITE = "write"
+
+STAGES = (STAGE_ADDRESS, STAGE_BUFFER_SIZE, STAGE_PAYLOAD, STAGE_WRITE)
+
+
+class AM32RetryPolicy:
+    """
+    stage_retries:  retries per resumable stage and write, a stage over its budget restarts the whole write,
+                    a failed set address always restarts the whole write
+    total_retries:  retries per write over all stages, then the write fails
+    backoff:        before a retry the input is drained after backoff_base * 2 ** retry seconds,
+                    at most backoff_max, late replies of the failed stage must not ACK the retry
+
+    Resuming: a NACKed payload is resent after a new set buffer size, the address is still set.
+    A NACKed write flash command is repeated, the payload is still in the ESC's buffer. So is a write flash
+    command whose ACK got lost, the ESC may have written the flash already, if the repeated write fails
+    the write budget runs out and the whole write restarts.
+    """
+
+    DEFAULT_STAGE_RETRIES = {
+        STAGE_PAYLOAD: 4,
+        STAGE_WRITE: 2,
+    }
+
+    # stage a failed stage is resumed from while it is within its budget
+    RESUME_STAGES = {
+        STAGE_PAYLOAD: STAGE_BUFFER_SIZE,
+        STAGE_WRITE: STAGE_WRITE,
+    }
+
+    def __init__(self, stage_retries=None, total_retries=8, backoff_base=0.01, backoff_max=0.2):
+        self.stage_retries = dict(self.DEFAULT_STAGE_RETRIES)
+        if stage_retries is not None:
+            self.stage_retries.update(stage_retries)
+        self.total_retries = total_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def get_backoff(self, retry):
+        """:return: seconds to wait before retry number retry (0 based)"""
+        return min(self.backoff_max, self.backoff_base * 2 ** retry)
+
+    def get_resume_stage(self, failed_stage, stage_failures):
+        """
+        :param stage_failures: how often failed_stage has failed in this write, including this time
+        :return: stage to continue with
+        """
+        if stage_failures > self.stage_retries.get(failed_stage, 0):
+            return STAGE_ADDRESS
+        return self.RESUME_STAGES.get(failed_stage, STAGE_ADDRESS)
@@ -0,0 +1,298 @@
+#!python3
+# -*- coding: utf-8 -*-
+
+"""
+    Record / replay layer for the serial port used by AM32Connector.
+    Captures every write and read with monotonic timestamps to a compact binary log,
+    replays a log deterministically and analyses where the time of a run went.
+
+    usage: python AM32SerialCapture.py capture.am32cap [other_capture.am32cap]
+
+    Copyright Julian Wingert, 2023, Licensed under the GPL V3
+"""
+
+import os
+import struct
+import sys
+import threading
+import time
+
+
+__author__ = 'Julian Wingert'
+__copyright__ = 'Copyright 2023, AM32 ESC Setup Tool'
+__license__ = 'GPL V3'
+__version__ = '0.1'
+__maintainer__ = 'Julian Wingert'
+__status__ = 'testing'
+
+
+CAPTURE_MAGIC = b"AM32CAP\x01"
+CAPTURE_FILE_EXTENSION = ".am32cap"
+
+# record: kind, microseconds since previous record, payload length, followed by the payload
+RECORD_HEADER = struct.Struct("<BII")
+RECORD_WRITE = ord('W')
+RECORD_READ = ord('R')
+RECORD_READ_EMPTY = ord('E')       # read_all() poll without data, no payload
+RECORD_FLUSH_INPUT = ord('F')
+
+MAX_DELTA_US = 0xffffffff
+
+
+def read_capture(filename):
+    """
+    Generator over all records of a capture file
+    :return: tuples of (kind, timestamp in seconds since capture start, payload bytes)
+    """
+    with open(filename, mode="rb") as capture_file:
+        if capture_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("%s is not an AM32 serial capture" % filename)
+
+        timestamp_us = 0
+        while header := capture_file.read(RECORD_HEADER.size):
+            if len(header) != RECORD_HEADER.size:
+                # truncated capture, e.g. the app died while recording
+                return
+            kind, delta_us, length = RECORD_HEADER.unpack(header)
+            payload = capture_file.read(length)
+            if len(payload) != length:
+                return
+            timestamp_us += delta_us
+            yield kind, timestamp_us / 1000000, payload
+
+
+def get_capture_filename(capture_dir):
+    """
+    Returns a new, timestamped capture file name inside capture_dir, creates capture_dir if needed.
+    A counter is appended if the name is taken, e.g. by a reconnect within the same millisecond.
+    """
+    os.makedirs(capture_dir, exist_ok=True)
+    now = time.time()
+    base_name = time.strftime("am32_%Y%m%d_%H%M%S", time.localtime(now)) + "_%03d" % (int(now * 1000) % 1000)
+    filename = os.path.join(capture_dir, base_name + CAPTURE_FILE_EXTENSION)
+    counter = 1
+    while os.path.exists(filename):
+        filename = os.path.join(capture_dir, "%s_%d%s" % (base_name, counter, CAPTURE_FILE_EXTENSION))
+        counter += 1
+    return filename
+
+
+class SerialCapture:
+    """
+    Wraps a serial port instance (serial.Serial or usbserial4a) and records all traffic.
+    Everything not recorded is passed through to the wrapped port.
+    """
+
+    def __init__(self, serial_port_instance, filename):
+        self.serial_port = serial_port_instance
+        self.filename = filename
+        # never overwrite an existing capture
+        self._capture_file = open(filename, mode="xb")
+        self._capture_file.write(CAPTURE_MAGIC)
+        self._last_timestamp_ns = time.monotonic_ns()
+        self._lock = threading.Lock()
+
+    def _record(self, kind, payload=b""):
+        with self._lock:
+            if self._capture_file is None:
+                return
+            now_ns = time.monotonic_ns()
+            delta_us = min((now_ns - self._last_timestamp_ns) // 1000, MAX_DELTA_US)
+            # keep the sub microsecond rest, otherwise rounding errors add up over a long flash
+            self._last_timestamp_ns += delta_us * 1000
+            self._capture_file.write(RECORD_HEADER.pack(kind, delta_us, len(payload)))
+            self._capture_file.write(payload)
+
+    def write(self, data):
+        result = self.serial_port.write(data)
+        self._record(RECORD_WRITE, bytes(data))
+        return result
+
+    def read_all(self):
+        data = self.serial_port.read_all()
+        if data:
+            self._record(RECORD_READ, bytes(data))
+        else:
+            self._record(RECORD_READ_EMPTY)
+        return data
+
+    def flushInput(self):
+        self.serial_port.flushInput()
+        self._record(RECORD_FLUSH_INPUT)
+
+    def close(self):
+        with self._lock:
+            if self._capture_file is not None:
+                self._capture_file.close()
+                self._capture_file = None
+        self.serial_port.close()
+
+    def __getattr__(self, name):
+        return getattr(self.serial_port, name)
+
+
+class SerialReplay:
+    """
+    Serial port replacement driven by a capture file.
+
+    Reads return exactly the recorded data in recorded order, writes are checked against the
+    recording. With realtime=True every record is delayed to its recorded time offset so field
+    timing can be reproduced; combine realtime=False with AM32Connector(wait_after_write=0)
+    to replay as fast as possible.
+    """
+
+    def __init__(self, filename, realtime=False, check_writes=True):
+        self.filename = filename
+        self.realtime = realtime
+        self.check_writes = check_writes
+        self._records = list(read_capture(filename))
+        self._position = 0
+        self._start_time = None
+
+    def _next_record(self, expected_kinds):
+        if self._position >= len(self._records):
+            raise ConnectionError("Replay of %s exhausted at record %d" % (self.filename, self._position))
+
+        kind, timestamp, payload = self._records[self._position]
+        if kind not in expected_kinds:
+            raise ConnectionError(
+                "Replay of %s diverged at record %d: expected %s, recorded %s" % (
+                    self.filename, self._position, "/".join(chr(k) for k in expected_kinds), chr(kind)
+                )
+            )
+        self._position += 1
+
+        if self.realtime:
+            if self._start_time is None:
+                self._start_time = time.monotonic() - timestamp
+            delay = self._start_time + timestamp - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        return payload
+
+    def write(self, data):
+        payload = self._next_record((RECORD_WRITE,))
+        if self.check_writes and payload != bytes(data):
+            raise ConnectionError(
+                "Replay of %s diverged at record %d: written data differs from recording" % (
+                    self.filename, self._position - 1
+                )
+            )
+        return len(data)
+
+    def read_all(self):
+        return self._next_record((RECORD_READ, RECORD_READ_EMPTY))
+
+    def flushInput(self):
+        self._next_record((RECORD_FLUSH_INPUT,))
+
+    def close(self):
+        pass
+
+    def is_finished(self):
+        return self._position >= len(self._records)
+
+
+def analyse_capture(filename):
+    """
+    Splits the run time of a capture into exchanges (a write followed by the reads until the next write)
+    and every exchange into time spent waiting for the ESC and time spent on the host.
+
+    device_response_time:       first poll until the first poll that returned data, the host only waits for the ESC
+    device_response_time_min:   first poll until the last empty poll before the data, the reply arrived between
+                                this and device_response_time
+    host_time:                  write until the first poll (sleep after writing), first data until the next write
+                                (remaining polls, host side sleeps), whole exchanges without a reply
+    device_response_time + host_time is the time of all exchanges
+    :return: dict with totals and per exchange details
+    """
+    exchanges = []
+    current = None
+    last_timestamp = 0.0
+    total_polls = 0
+    empty_polls = 0
+
+    for kind, timestamp, payload in read_capture(filename):
+        last_timestamp = timestamp
+        if kind == RECORD_WRITE:
+            if current is not None:
+                current["end"] = timestamp
+                exchanges.append(current)
+            current = {"start": timestamp, "written": len(payload), "first_poll": None, "last_empty": None,
+                       "first_data": None, "end": None, "polls": 0, "read": 0}
+            continue
+
+        if current is None or kind == RECORD_FLUSH_INPUT:
+            continue
+
+        total_polls += 1
+        current["polls"] += 1
+        if current["first_poll"] is None:
+            current["first_poll"] = timestamp
+        if kind == RECORD_READ:
+            current["read"] += len(payload)
+            if current["first_data"] is None:
+                current["first_data"] = timestamp
+        else:
+            empty_polls += 1
+            if current["first_data"] is None:
+                current["last_empty"] = timestamp
+
+    if current is not None:
+        current["end"] = last_timestamp
+        exchanges.append(current)
+
+    device_response_time = 0.0
+    device_response_time_min = 0.0
+    host_time = 0.0
+    unanswered = 0
+    for exchange in exchanges:
+        if exchange["first_data"] is None:
+            unanswered += 1
+            host_time += exchange["end"] - exchange["start"]
+            continue
+
+        device_response_time += exchange["first_data"] - exchange["first_poll"]
+        if exchange["last_empty"] is not None:
+            device_response_time_min += exchange["last_empty"] - exchange["first_poll"]
+        host_time += (exchange["first_poll"] - exchange["start"]) + (exchange["end"] - exchange["first_data"])
+
+    return {
+        "filename": filename,
+        "total_time": last_timestamp,
+        "exchanges": len(exchanges),
+        "unanswered_exchanges": unanswered,
+        "bytes_written": sum(exchange["written"] for exchange in exchanges),
+        "bytes_read": sum(exchange["read"] for exchange in exchanges),
+        "polls": total_polls,
+        "empty_polls": empty_polls,
+        "device_response_time": device_response_time,
+        "device_response_time_min": device_response_time_min,
+        "host_time": host_time,
+        "details": exchanges,
+    }
+
+
+def print_analysis(analysis, reference=None):
+    keys = ["total_time", "exchanges", "unanswered_exchanges", "bytes_written", "bytes_read", "polls",
+            "empty_polls", "device_response_time", "device_response_time_min", "host_time"]
+    print(analysis["filename"])
+    for key in keys:
+        line = "  %-24s %12.3f" % (key, analysis[key])
+        if reference is not None:
+            line += "  %12.3f  (%+.3f)" % (reference[key], analysis[key] - reference[key])
+        print(line)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    first_analysis = analyse_capture(sys.argv[1])
+    if len(sys.argv) > 2:
+        # compare two runs, second one is the reference
+        print_analysis(first_analysis, reference=analyse_capture(sys.argv[2]))
+    else:
+        print_analysis(first_analysis)
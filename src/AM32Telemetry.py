@@ -0,0 +1,393 @@
+#!python3
+# -*- coding: utf-8 -*-
+
+"""
+    Streaming decoder for the AM32 ESC serial telemetry (enabled with eeprom byte 31, telemetry_30ms).
+    Decodes the 10 byte KISS / BLHeli32 telemetry frames, validates their CRC8, keeps rolling
+    statistics in fixed size ring buffers and optionally exports the frames as CSV or binary.
+
+    frame: temperature (C), voltage (10mV), current (10mA), consumption (mAh), eRPM (100 eRPM), CRC8
+    all multi byte values are big endian
+
+    usage: python AM32Telemetry.py <serial port | capture.am32cap | raw dump> [...] [--csv out.csv | --binary out.bin]
+
+    Copyright Julian Wingert, 2023, Licensed under the GPL V3
+"""
+
+import argparse
+import csv
+import os
+import struct
+import sys
+import time
+from array import array
+from collections import deque, namedtuple
+
+from AM32SerialCapture import CAPTURE_FILE_EXTENSION, RECORD_READ, RECORD_READ_EMPTY, read_capture
+
+
+__author__ = 'Julian Wingert'
+__copyright__ = 'Copyright 2023, AM32 ESC Setup Tool'
+__license__ = 'GPL V3'
+__version__ = '0.1'
+__maintainer__ = 'Julian Wingert'
+__status__ = 'testing'
+
+
+# the ESC sends its telemetry at 115200 baud, not at the 19200 baud of the bootloader
+TELEMETRY_BAUDRATE = 115200
+
+TELEMETRY_FRAME = struct.Struct(">BHHHHB")
+TELEMETRY_FIELDS = ("temperature", "voltage", "current", "consumption", "erpm")
+
+TelemetryFrame = namedtuple("TelemetryFrame", ("timestamp",) + TELEMETRY_FIELDS)
+
+
+def _build_crc8_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for j in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ 0x07) & 0xff
+            else:
+                crc = (crc << 1) & 0xff
+        table.append(crc)
+    return bytes(table)
+
+
+CRC8_TABLE = _build_crc8_table()
+
+
+def crc8(crc_buffer):
+    """CRC8 as used by the KISS telemetry, polynomial 0x07, init 0"""
+    crc = 0
+    for xb in crc_buffer:
+        crc = CRC8_TABLE[crc ^ xb]
+    return crc
+
+
+class AM32TelemetryDecoder:
+    """
+    Turns a byte stream into TelemetryFrames. Bytes are fed in any portions, on a CRC mismatch
+    the decoder drops one byte and tries again, so it resynchronizes after noise or a lost byte.
+    Leading zero bytes do not change the CRC8, so a run of zeros (idle or break line) alone or in front of
+    the start of a frame can look valid. Frames starting with 0 C and a voltage below 2.56 V are impossible
+    for a running ESC and are dropped like CRC mismatches.
+    """
+
+    FRAME_SIZE = TELEMETRY_FRAME.size
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.frames_decoded = 0
+        self.bytes_dropped = 0
+
+    def feed(self, data, timestamp=None):
+        """:return: list of the TelemetryFrames completed by data"""
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self._buffer += data
+
+        frames = []
+        position = 0
+        while len(self._buffer) - position >= self.FRAME_SIZE:
+            end = position + self.FRAME_SIZE
+            if (crc8(self._buffer[position:end - 1]) != self._buffer[end - 1]
+                    or not (self._buffer[position] or self._buffer[position + 1])):
+                position += 1
+                self.bytes_dropped += 1
+                continue
+
+            temperature, voltage, current, consumption, erpm, crc = TELEMETRY_FRAME.unpack_from(self._buffer, position)
+            frames.append(TelemetryFrame(
+                timestamp, temperature, voltage / 100, current / 100, consumption, erpm * 100
+            ))
+            position = end
+
+        del self._buffer[:position]
+        self.frames_decoded += len(frames)
+        return frames
+
+
+class RollingStatistic:
+    """
+    min / max / mean over the last 'window' values, updated in O(1) (amortized) per value.
+    The values live in a preallocated ring buffer, min and max in monotonic deques,
+    so memory does not grow with the number of values.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._values = array('d', [0.0] * window)
+        self._count = 0         # values seen in total
+        self._sum = 0.0
+        self._min = deque()     # (index, value), increasing values
+        self._max = deque()     # (index, value), decreasing values
+
+    def add(self, value):
+        index = self._count
+        slot = index % self.window
+        if index >= self.window:
+            self._sum -= self._values[slot]
+        self._values[slot] = value
+        self._sum += value
+        self._count += 1
+
+        oldest_index = self._count - self.window
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((index, value))
+        if self._min[0][0] < oldest_index:
+            self._min.popleft()
+
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((index, value))
+        if self._max[0][0] < oldest_index:
+            self._max.popleft()
+
+    def __len__(self):
+        return min(self._count, self.window)
+
+    @property
+    def minimum(self):
+        return self._min[0][1] if self._min else None
+
+    @property
+    def maximum(self):
+        return self._max[0][1] if self._max else None
+
+    @property
+    def mean(self):
+        return self._sum / len(self) if self._count else None
+
+    @property
+    def last(self):
+        return self._values[(self._count - 1) % self.window] if self._count else None
+
+    def values(self):
+        """:return: the values in the window, oldest first"""
+        if self._count <= self.window:
+            return list(self._values[:self._count])
+        slot = self._count % self.window
+        return list(self._values[slot:]) + list(self._values[:slot])
+
+
+class AM32TelemetryStatistics:
+    """Rolling statistics of all telemetry fields of one ESC"""
+
+    def __init__(self, window=1024):
+        self.window = window
+        self.fields = {name: RollingStatistic(window) for name in TELEMETRY_FIELDS}
+        self.frames = 0
+
+    def add(self, frame):
+        self.frames += 1
+        for name in TELEMETRY_FIELDS:
+            self.fields[name].add(getattr(frame, name))
+
+    def __getitem__(self, name):
+        return self.fields[name]
+
+    def summary(self):
+        return {
+            name: {"last": field.last, "min": field.minimum, "max": field.maximum, "mean": field.mean}
+            for name, field in self.fields.items()
+        }
+
+
+class TelemetryExporter:
+    """
+    Writes frames to a CSV file or, with binary=True, as packed records
+    (esc number, timestamp as double, then the raw frame values) for compact long recordings.
+    """
+
+    BINARY_RECORD = struct.Struct("<BdBHHHI")
+
+    def __init__(self, filename, binary=False):
+        self.filename = filename
+        self.binary = binary
+        if binary:
+            self._file = open(filename, mode="wb")
+            self._csv_writer = None
+        else:
+            self._file = open(filename, mode="w", newline="")
+            self._csv_writer = csv.writer(self._file)
+            self._csv_writer.writerow(("esc",) + TelemetryFrame._fields)
+
+    def write(self, esc_number, frame):
+        if self.binary:
+            self._file.write(self.BINARY_RECORD.pack(
+                esc_number, frame.timestamp, frame.temperature, round(frame.voltage * 100),
+                round(frame.current * 100), frame.consumption, frame.erpm
+            ))
+        else:
+            self._csv_writer.writerow((esc_number,) + tuple(frame))
+
+    def close(self):
+        self._file.close()
+
+
+class TelemetryReplaySource:
+    """
+    Offline telemetry source with the read_all() interface of a serial port.
+    Every read_all() returns the next recorded portion of data, b"" when the recording is exhausted.
+    """
+
+    def __init__(self, reads, timestamps=None, realtime=False):
+        self._reads = list(reads)
+        self._timestamps = timestamps
+        self.realtime = realtime
+        self._position = 0
+        self._start_time = None
+
+    @classmethod
+    def from_capture(cls, filename, realtime=False):
+        """Replays the reads of an AM32SerialCapture recording"""
+        reads = []
+        timestamps = []
+        for kind, timestamp, payload in read_capture(filename):
+            if kind in (RECORD_READ, RECORD_READ_EMPTY):
+                reads.append(payload)
+                timestamps.append(timestamp)
+        return cls(reads, timestamps=timestamps, realtime=realtime)
+
+    @classmethod
+    def from_raw_file(cls, filename, read_size=64):
+        """Replays a raw byte dump of the telemetry line in portions of read_size bytes"""
+        with open(filename, mode="rb") as raw_file:
+            data = raw_file.read()
+        return cls(data[i:i + read_size] for i in range(0, len(data), read_size))
+
+    def read_all(self):
+        if self._position >= len(self._reads):
+            return b""
+
+        if self.realtime and self._timestamps is not None:
+            timestamp = self._timestamps[self._position]
+            if self._start_time is None:
+                self._start_time = time.monotonic() - timestamp
+            delay = self._start_time + timestamp - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        data = self._reads[self._position]
+        self._position += 1
+        return data
+
+    def is_finished(self):
+        return self._position >= len(self._reads)
+
+    def close(self):
+        pass
+
+
+class AM32TelemetryMonitor:
+    """
+    Polls the telemetry sources of several ESCs (serial ports or TelemetryReplaySources),
+    decodes their frames, updates the statistics and exports them.
+    Call poll() at least every 30 ms or from a thread with run().
+    """
+
+    def __init__(self, window=1024, exporter=None):
+        self.window = window
+        self.exporter = exporter
+        self.sources = {}       # esc number -> (source, decoder, statistics)
+
+    def add_source(self, esc_number, source):
+        self.sources[esc_number] = (source, AM32TelemetryDecoder(), AM32TelemetryStatistics(self.window))
+
+    def get_statistics(self, esc_number):
+        return self.sources[esc_number][2]
+
+    def poll(self):
+        """:return: number of frames decoded"""
+        frames_decoded = 0
+        for esc_number, (source, decoder, statistics) in self.sources.items():
+            data = source.read_all()
+            if not data:
+                continue
+            for frame in decoder.feed(data):
+                statistics.add(frame)
+                if self.exporter is not None:
+                    self.exporter.write(esc_number, frame)
+                frames_decoded += 1
+        return frames_decoded
+
+    def run(self, stop_event, poll_interval=0.01):
+        """Polls until stop_event (threading.Event) is set"""
+        while not stop_event.is_set():
+            self.poll()
+            stop_event.wait(poll_interval)
+
+
+def open_source(name, baudrate=TELEMETRY_BAUDRATE, realtime=False):
+    """:return: a replay source for a capture or raw dump file, otherwise name is opened as serial port"""
+    if name.endswith(CAPTURE_FILE_EXTENSION):
+        return TelemetryReplaySource.from_capture(name, realtime=realtime)
+    if os.path.isfile(name):
+        return TelemetryReplaySource.from_raw_file(name)
+    from serial import Serial
+
+    return Serial(name, baudrate, 8, 'N', 1, timeout=0)
+
+
+def print_summary(monitor):
+    for esc_number, (source, decoder, statistics) in monitor.sources.items():
+        line = "esc %d: %d frames, %d bytes dropped" % (esc_number, decoder.frames_decoded, decoder.bytes_dropped)
+        for name, values in statistics.summary().items():
+            if values["last"] is not None:
+                line += ", %s %g (%g..%g)" % (name, values["last"], values["min"], values["max"])
+        print(line)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="AM32 ESC telemetry monitor")
+    parser.add_argument("sources", nargs="+",
+                        help="serial port, capture (%s) or raw dump per ESC" % CAPTURE_FILE_EXTENSION)
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--csv", help="export the frames to a CSV file")
+    output.add_argument("--binary", help="export the frames as packed binary records")
+    parser.add_argument("--baudrate", type=int, default=TELEMETRY_BAUDRATE, help="baudrate of serial ports")
+    parser.add_argument("--window", type=int, default=1024, help="frames in the rolling statistics")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between two summaries")
+    parser.add_argument("--realtime", action="store_true", help="replay captures in their recorded timing")
+    args = parser.parse_args(argv[1:])
+
+    exporter = None
+    if args.csv:
+        exporter = TelemetryExporter(args.csv)
+    elif args.binary:
+        exporter = TelemetryExporter(args.binary, binary=True)
+
+    monitor = AM32TelemetryMonitor(window=args.window, exporter=exporter)
+    for esc_number, name in enumerate(args.sources):
+        monitor.add_source(esc_number, open_source(name, args.baudrate, args.realtime))
+
+    replay_only = all(isinstance(source, TelemetryReplaySource) for source, _, _ in monitor.sources.values())
+    next_summary = time.monotonic() + args.interval
+    try:
+        while True:
+            monitor.poll()
+            if replay_only and all(source.is_finished() for source, _, _ in monitor.sources.values()):
+                break
+            if time.monotonic() >= next_summary:
+                print_summary(monitor)
+                next_summary += args.interval
+            if not replay_only:
+                time.sleep(0.01)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for source, _, _ in monitor.sources.values():
+            source.close()
+        if exporter is not None:
+            exporter.close()
+
+    print_summary(monitor)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
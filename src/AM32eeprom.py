@@ -159,7 +159,7 @@ class AM32eeprom:
          "description": "current protection level (value x 2) above 100 disables", "type": "number", "min_value": 2,
          "max_value": 102, "default_value": 102, "scaling_factor": 1, "offset": 0, "label": "current limit amps"},
         {"byte_number": 45, "app_page": "Crawler", "name": "sine_mode_power", "description": "sine mode strength 1-10",
-         "type": "number", "min_value": 0, "max_value": 1, "default_value": 6, "scaling_factor": 1, "offset": 0,
+         "type": "number", "min_value": 1, "max_value": 10, "default_value": 6, "scaling_factor": 1, "offset": 0,
          "label": "sine mode power"},
         {"byte_number": 46, "app_page": "RC", "name": "input_mode_selector",
          "description": "input type selector 1)Auto 2)Dshot only 3)Servo only 4)PWM 5)Serial 6)BetaFlight Safe Arming",
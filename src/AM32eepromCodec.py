@@ -0,0 +1,171 @@
+#!python3
+# -*- coding: utf-8 -*-
+
+"""
+    Bulk codec for many eeprom images at once, e.g. for the analysis of eeprom dumps of a fleet.
+    AM32eeprom.EEPROM_INFO is compiled into a NumPy structured dtype, decoding, scaling,
+    range checks and diffs against a profile run vectorized over all images.
+
+    NumPy is optional, only this module needs it.
+
+    Copyright Julian Wingert, 2023, Licensed under the GPL V3
+"""
+
+import sys
+
+from AM32eeprom import AM32eeprom
+
+
+__author__ = 'Julian Wingert'
+__copyright__ = 'Copyright 2023, AM32 ESC Setup Tool'
+__license__ = 'GPL V3'
+__version__ = '0.1'
+__maintainer__ = 'Julian Wingert'
+__status__ = 'testing'
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("the bulk eeprom codec needs numpy, install it with 'pip install numpy'") from None
+    return numpy
+
+
+class AM32eepromCodec:
+    """
+    Codec for arrays of eeprom images.
+
+    records: NumPy structured array, one record per image, one uint8 field per EEPROM_INFO entry
+    raw:     (N, EEPROM_SIZE) uint8 view of the same memory, columns are byte numbers
+
+    Range checks skip the "character" fields (ESC name), their min / max values are not meaningful.
+    """
+
+    EEPROM_SIZE = 48
+
+    def __init__(self, eeprom_info=None):
+        np = _import_numpy()
+        self.np = np
+        if eeprom_info is None:
+            eeprom_info = AM32eeprom.EEPROM_INFO
+        self.eeprom_info = sorted(eeprom_info, key=lambda byte_info: byte_info["byte_number"])
+
+        self.names = [byte_info["name"] for byte_info in self.eeprom_info]
+        self.byte_numbers = np.array([byte_info["byte_number"] for byte_info in self.eeprom_info], dtype=np.intp)
+        self.dtype = np.dtype({
+            "names": self.names,
+            "formats": [np.uint8] * len(self.eeprom_info),
+            "offsets": self.byte_numbers.tolist(),
+            "itemsize": self.EEPROM_SIZE,
+        })
+
+        # per field constants, one column per EEPROM_INFO entry
+        self.scaling_factors = np.array([byte_info["scaling_factor"] for byte_info in self.eeprom_info], dtype=float)
+        self.offsets = np.array([byte_info["offset"] for byte_info in self.eeprom_info], dtype=float)
+        self.min_values = np.array([byte_info["min_value"] for byte_info in self.eeprom_info], dtype=np.int16)
+        self.max_values = np.array([byte_info["max_value"] for byte_info in self.eeprom_info], dtype=np.int16)
+        self.range_checked = np.array([byte_info["type"] != "character" for byte_info in self.eeprom_info])
+        self.defaults = np.array([byte_info["default_value"] for byte_info in self.eeprom_info], dtype=np.uint8)
+
+    def decode(self, data):
+        """
+        :param data: bytes like of N * EEPROM_SIZE bytes, a list of eeprom images or an (N, EEPROM_SIZE) uint8 array
+        :return: structured array of N records, shares memory with data where possible
+        """
+        np = self.np
+        if isinstance(data, (list, tuple)):
+            data = b"".join(bytes(image) for image in data)
+        if isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data, dtype=np.uint8)
+        records = np.frombuffer(data, dtype=np.uint8)
+        if records.size % self.EEPROM_SIZE:
+            raise ValueError("eeprom size mismatch, %d bytes are no multiple of %d" % (records.size, self.EEPROM_SIZE))
+        return records.view(self.dtype)
+
+    def read_file(self, filename):
+        """Decodes a dump file of concatenated eeprom images"""
+        with open(filename, mode="rb") as dump_file:
+            return self.decode(dump_file.read())
+
+    def encode(self, records):
+        """:return: the records as bytes, N * EEPROM_SIZE"""
+        return self.np.ascontiguousarray(records).tobytes()
+
+    def get_raw(self, records):
+        """:return: (N, EEPROM_SIZE) uint8 view of records"""
+        return self.np.ascontiguousarray(records).view(self.np.uint8).reshape(-1, self.EEPROM_SIZE)
+
+    def _columns(self, records):
+        # raw values ordered like self.names
+        return self.get_raw(records)[:, self.byte_numbers]
+
+    def scale(self, records):
+        """:return: (N, fields) float array, value * scaling_factor + offset like AM32eeprom.scale_value"""
+        return self._columns(records) * self.scaling_factors + self.offsets
+
+    def unscale(self, values):
+        """
+        Inverse of scale(), rounds to the nearest raw value
+        :return: structured array of the raw values, encode() it to get the eeprom images
+        """
+        np = self.np
+        raw_values = np.rint((np.asarray(values, dtype=float) - self.offsets) / self.scaling_factors)
+        raw = np.zeros((len(raw_values), self.EEPROM_SIZE), dtype=np.uint8)
+        raw[:, self.byte_numbers] = np.clip(raw_values, 0, 255)
+        return raw.reshape(-1).view(self.dtype)
+
+    def get_out_of_range(self, records):
+        """:return: (N, fields) bool array, True where a raw value is outside min_value / max_value"""
+        columns = self._columns(records).astype(self.np.int16)
+        return ((columns < self.min_values) | (columns > self.max_values)) & self.range_checked
+
+    def get_invalid(self, records):
+        """:return: (N,) bool array, True for images with at least one value out of range"""
+        return self.get_out_of_range(records).any(axis=1)
+
+    def diff(self, records, profile=None):
+        """
+        :param profile: AM32eeprom, eeprom image bytes or None for the defaults
+        :return: (N, fields) bool array, True where a value differs from the profile
+        """
+        if profile is None:
+            profile_columns = self.defaults
+        else:
+            if isinstance(profile, AM32eeprom):
+                profile = profile.get_eeprom_bytearray()
+            profile_columns = self._columns(self.decode(bytes(profile)))[0]
+        return self._columns(records) != profile_columns
+
+    def count_by_field(self, mask):
+        """:return: {field name: count} of the fields set in at least one image of a (N, fields) bool array"""
+        counts = mask.sum(axis=0)
+        return {name: int(count) for name, count in zip(self.names, counts) if count}
+
+
+def main(argv):
+    if len(argv) < 2:
+        print("usage: %s <eeprom dump> [<profile eeprom>]" % argv[0])
+        return 2
+
+    codec = AM32eepromCodec()
+    records = codec.read_file(argv[1])
+    profile = None
+    if len(argv) > 2:
+        with open(argv[2], mode="rb") as profile_file:
+            profile = profile_file.read(codec.EEPROM_SIZE)
+
+    out_of_range = codec.get_out_of_range(records)
+    print("%d eeprom images, %d with values out of range" % (len(records), out_of_range.any(axis=1).sum()))
+    for name, count in codec.count_by_field(out_of_range).items():
+        print("  out of range  %-32s %d" % (name, count))
+
+    differences = codec.diff(records, profile)
+    print("%d images differ from the %s" % (differences.any(axis=1).sum(), "profile" if profile else "defaults"))
+    for name, count in codec.count_by_field(differences).items():
+        print("  differs       %-32s %d" % (name, count))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
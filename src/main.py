@@ -9,37 +9,32 @@
 """
 
 import os
+import sys
+
+# set AM32_PROFILE_STARTUP=1 to print an import time report at the first frame and on exit
+if os.environ.get("AM32_PROFILE_STARTUP") == "1":
+    from AM32ImportProfiler import AM32ImportProfiler
+    import_profiler = AM32ImportProfiler()
+    import_profiler.install()
+else:
+    import_profiler = None
 
 import threading
 
+# AM32FlashWorker.FLASH_WORKER_ARGUMENT, compared as literal, the worker module is only imported when used
+if __name__ == '__main__' and "--am32-flash-worker" in sys.argv:
+    # frozen builds start the flashing worker through the app executable, no kivy needed for it
+    from AM32FlashWorker import worker_main
+    sys.exit(worker_main())
+
+# only what the first frame (ESC tab) needs is imported here, widgets, serial and
+# firmware tooling are imported on first use
 from kivy.app import App
 from kivy.uix.widget import Widget
-from kivy.uix.boxlayout import BoxLayout
-from kivy.uix.gridlayout import GridLayout
-from kivy.uix.label import Label
-from kivy.uix.button import Button
-from kivy.uix.checkbox import CheckBox
-from kivy.uix.textinput import TextInput
-from kivy.uix.slider import Slider
-from kivy.uix.tabbedpanel import TabbedPanel, TabbedPanelItem
-from kivy.uix.scrollview import ScrollView
-from kivy.core.window import Window
 from kivy.uix.floatlayout import FloatLayout
 from kivy.properties import ObjectProperty
-from kivy.uix.popup import Popup
-from kivy.clock import Clock
-
+from kivy.clock import Clock, mainthread
 from kivy.utils import platform
-if platform == 'android':
-    from usb4a import usb
-    from usbserial4a import serial4a
-else:
-    from serial.tools import list_ports
-    from serial import Serial
-    from serial.serialutil import SerialException
-
-from AM32eeprom import AM32eeprom
-from AM32Connector import AM32Connector
 
 
 __author__ = 'Julian Wingert'
@@ -49,6 +44,15 @@ __version__ = '0.1'
 __maintainer__ = 'Julian Wingert'
 __status__ = 'testing'
 
+# set AM32_SERIAL_CAPTURE to a directory to record all serial traffic for offline analysis
+SERIAL_CAPTURE_DIR = os.environ.get("AM32_SERIAL_CAPTURE")
+# set AM32_FLASH_WORKER=1 to flash from a separate process (not available on android)
+FLASH_WORKER_ENABLED = os.environ.get("AM32_FLASH_WORKER") == "1" and platform != 'android'
+
+
+if import_profiler is not None:
+    import_profiler.mark("main module imported")
+
 
 class AM32ConftoolLayout(Widget):
     pass
@@ -59,6 +63,8 @@ class LoadDialog(FloatLayout):
     cancel = ObjectProperty(None)
 
     def __init__(self, **kwargs):
+        from kivy.uix.button import Button
+
         super(LoadDialog, self).__init__(**kwargs)
         for drive in self.get_win_drives():
             self.ids.disk_drives.add_widget(Button(text=drive, on_press=self.drive_selection_changed))
@@ -96,25 +102,65 @@ class AM32SetupToolApp(App):
     def __init__(self):
         App.__init__(self)
         self.device_name_list = []
-        self.eeprom = AM32eeprom()
+        self.eeprom = None
         self.serial_port = None
         self.esc = None
-        self.slider_list = [None] * len(self.eeprom.EEPROM)
-        self.text_info_list = [None] * len(self.eeprom.EEPROM)
-        self.checkbox_list = [None] * len(self.eeprom.EEPROM)
-        self.select_input_list = [None] * len(self.eeprom.EEPROM)
+        self.connect_worker = None
+        self.flash_worker = None
+        self.scheduler = None
+        self.flash_future = None
+        self.flash_percent_done = 0
+        self.serial_device_name = None
+        # per eeprom byte widget lists, allocated with the config tabs
+        self.slider_list = []
+        self.text_info_list = []
+        self.checkbox_list = []
+        self.select_input_list = []
         self.pages = {}
+        self.firmware_tab = None
         self.fw_file_full_path = None
+        self.firmware_library = None
 
     def build(self):
         return AM32ConftoolLayout()
 
+    def on_start(self):
+        if import_profiler is not None:
+            import_profiler.mark("app started")
+            from kivy.core.window import Window
+
+            # on_flip fires when a drawn frame is swapped to the screen, on_start is earlier
+            Window.bind(on_flip=self.callback_first_frame)
+
+    def on_stop(self):
+        if import_profiler is not None:
+            # includes everything imported on first use
+            import_profiler.mark("app stopped")
+            import_profiler.report()
+
+    def callback_first_frame(self, window):
+        window.unbind(on_flip=self.callback_first_frame)
+        import_profiler.mark("first frame")
+        import_profiler.report()
+
+    def build_firmware_tab(self):
+        """The firmware tab is only needed once an ESC is connected, it is not part of the first frame"""
+        if self.firmware_tab is not None:
+            return
+        from kivy.factory import Factory
+
+        self.firmware_tab = Factory.FirmwareTab()
+        self.root.ids.tp_main.add_widget(self.firmware_tab)
+
     def callback_button_save(self, instance):
         print("callback_button_save", self, instance.state)
-        try:
-            self.esc.write_eeprom(self.eeprom.get_eeprom_bytearray())
-        except Exception as e:
-            print("Exception: %s" % str(e))
+        self.scheduler.write_eeprom(self.eeprom.get_eeprom_bytearray()).add_done_callback(self.callback_command_done)
+
+    @staticmethod
+    def callback_command_done(future):
+        """Done callback of scheduler commands without a result the GUI waits for"""
+        if future.exception() is not None:
+            print("Exception: %s" % str(future.exception()))
 
     def callback_button_update_usb_list(self, instance):
         print("callback_button_update_usb_list", self, instance.state)
@@ -138,25 +184,85 @@ class AM32SetupToolApp(App):
 
     def callback_button_serial_device(self, instance):
         print("callback_button_serial_device", self, instance.text)
+        from kivy.uix.button import Button
+        from AM32ConnectWorker import AM32ConnectWorker
+
         serial_device_name = instance.text
-        self.open_serial_port(serial_device_name)
-        print("SERIAL open done")
-        if self.serial_port is None:
-            self.root.ids.l_usb_devices.text = "ERR: TIMEOUT (%s)" % serial_device_name
-            return
-        self.connect_esc()
-        print("connect esc done")
+        self.serial_device_name = serial_device_name
 
-        # load eeprom from esc
-        eeprom_data = self.esc.cmd_read_eeprom()
-        # check eeprom for correct version
-        test_eeprom = AM32eeprom()
-        # after connecting, update the local eeprom data with the real data from the esc
-        if test_eeprom[1] == eeprom_data[1]:
-            self.eeprom = AM32eeprom(eeprom_bytearray=eeprom_data)
-        else:
-            # eeprom version did not match
-            self.write_default_eeprom()
+        # connect in the background, the GUI stays responsive and the connect can be cancelled
+        self.root.ids.bl_usb_serial_devices.clear_widgets()
+        self.root.ids.bl_usb_serial_devices.add_widget(
+            Button(text="cancel", on_press=self.callback_button_cancel_connect)
+        )
+        self.root.ids.b_update_usb_list.disabled = True
+        self.root.ids.l_usb_devices.text = "connecting to %s" % serial_device_name
+
+        self.connect_worker = AM32ConnectWorker(
+            serial_device_name, self.open_serial_port,
+            on_status=self.callback_connect_status,
+            on_result=self.callback_connect_result,
+            on_error=self.callback_connect_error
+        )
+        self.connect_worker.start()
+
+    def callback_button_cancel_connect(self, instance):
+        print("callback_button_cancel_connect", self, instance.text)
+        if self.connect_worker is not None:
+            self.connect_worker.cancel()
+
+    def open_serial_port(self, serial_device_name):
+        """Opens the serial port, optionally wrapped in a capture. Called from the connect worker thread"""
+        serial_port = self.open_serial_device(serial_device_name)
+        if serial_port is not None and SERIAL_CAPTURE_DIR:
+            from AM32SerialCapture import SerialCapture, get_capture_filename
+
+            capture_filename = get_capture_filename(SERIAL_CAPTURE_DIR)
+            print("capturing serial traffic to %s" % capture_filename)
+            serial_port = SerialCapture(serial_port, capture_filename)
+        return serial_port
+
+    @mainthread
+    def callback_connect_status(self, text):
+        self.root.ids.l_usb_devices.text = text
+
+    @mainthread
+    def callback_connect_error(self, text):
+        self.connect_worker = None
+        self.root.ids.b_update_usb_list.disabled = False
+        self.update_serial_devices()
+        self.root.ids.l_usb_devices.text = text
+
+    def get_flash_plan_cache_dir(self):
+        return os.path.join(self.user_data_dir, "flash_plans")
+
+    def get_flash_delta_filename(self):
+        return os.path.join(self.user_data_dir, "flash_delta.json")
+
+    def set_connected_esc(self, serial_port, esc):
+        from AM32CommandScheduler import AM32CommandScheduler
+        from AM32FlashDelta import AM32FlashDelta
+        from AM32FlashPlan import AM32FlashPlanCache
+
+        self.serial_port = serial_port
+        self.esc = esc
+        self.esc.flash_plan_cache = AM32FlashPlanCache(self.get_flash_plan_cache_dir())
+        self.esc.flash_delta = AM32FlashDelta(self.get_flash_delta_filename())
+        # from now on only the scheduler's thread talks to the ESC
+        self.scheduler = AM32CommandScheduler(self.esc)
+        self.scheduler.start()
+
+    @mainthread
+    def callback_connect_result(self, serial_port, esc, eeprom):
+        from kivy.core.window import Window
+        from kivy.uix.scrollview import ScrollView
+        from kivy.uix.tabbedpanel import TabbedPanelItem
+
+        self.connect_worker = None
+        self.set_connected_esc(serial_port, esc)
+        # after connecting, the local eeprom data is the real data from the esc
+        self.eeprom = eeprom
+        print("connect esc done")
 
         # no more need to connect a device, disable buttons
         self.root.ids.bl_usb_serial_devices.clear_widgets()
@@ -172,23 +278,52 @@ class AM32SetupToolApp(App):
             tab_item.add_widget(scrollview)
             self.root.ids.tp_main.add_widget(tab_item)
 
-        # and enable the save button and the firmware tab
+        # and enable the save button and show the firmware tab
         self.root.ids.b_save_to_esc.disabled = False
-        self.root.ids.b_write_default_eeprom.disabled = False
-        self.root.ids.tpi_firmware.disabled = False
+        self.build_firmware_tab()
+        self.firmware_tab.ids.b_write_default_eeprom.disabled = False
+
+        # index the local firmware images in the background
+        threading.Thread(target=self.scan_firmware_library, daemon=True).start()
+
+    def scan_firmware_library(self):
+        from AM32FirmwareLibrary import AM32FirmwareLibrary
+
+        if self.firmware_library is None:
+            self.firmware_library = AM32FirmwareLibrary(
+                [get_download_path()], os.path.join(self.user_data_dir, "firmware_index.json")
+            )
+        self.firmware_library.scan()
+        self.callback_firmware_library_scanned()
+
+    @mainthread
+    def callback_firmware_library_scanned(self):
+        if self.esc is None or self.fw_file_full_path is not None:
+            return
+        matching_images = self.firmware_library.lookup(self.esc.esc_type)
+        self.firmware_tab.ids.l_flash_fw_filename.text = "%d firmware image(s) for %s ESC found" % (
+            len(matching_images), self.firmware_library.get_esc_type_name(self.esc.esc_type)
+        )
 
     def write_default_eeprom(self):
+        from AM32eeprom import AM32eeprom
+
         # eeprom version did not match, load default eeprom
         self.eeprom = AM32eeprom()
         # and write it
-        self.esc.write_eeprom(self.eeprom.get_eeprom_bytearray())
+        self.scheduler.write_eeprom(self.eeprom.get_eeprom_bytearray()).add_done_callback(self.callback_command_done)
 
     def callback_button_write_default_eeprom(self, instance):
         self.write_default_eeprom()
 
     def callback_button_fw_file(self, instance):
+        from kivy.uix.popup import Popup
+
         self.content = LoadDialog(load=self.load_fw_file, cancel=self.dismiss_popup)
         self.content.ids.filechooser.path = get_download_path()
+        if self.firmware_library is not None and self.esc is not None:
+            # only show images matching the connected ESC
+            self.content.ids.filechooser.filters = [self.firmware_library.get_filechooser_filter(self.esc.esc_type)]
         self._popup = Popup(title="Load file", content=self.content,
                             size_hint=(0.9, 0.9))
         self._popup.open()
@@ -203,46 +338,158 @@ class AM32SetupToolApp(App):
         self.fw_file_full_path = os.path.join(path, filename[0])
 
         if os.path.isfile(self.fw_file_full_path):
-            self.root.ids.l_flash_fw_filename.text = "FLASH FROM: '%s'" % os.path.basename(filename[0])
-            self.root.ids.b_flash_firmware_file.disabled = False
+            self.firmware_tab.ids.l_flash_fw_filename.text = "FLASH FROM: '%s'" % os.path.basename(filename[0])
+            entry = None
+            if self.firmware_library is not None:
+                entry = self.firmware_library.get_entry(os.path.normpath(self.fw_file_full_path))
+            if entry is not None and entry["version"] is not None:
+                self.firmware_tab.ids.l_flash_fw_filename.text += " (%d.%02d)" % tuple(entry["version"])
+            self.firmware_tab.ids.b_flash_firmware_file.disabled = False
             self.dismiss_popup()
         else:
             self.fw_file_full_path = None
 
     def callback_button_flash_fw_file(self, instance):
         # disable flash button and save button to prevent threading chaos
-        self.root.ids.b_flash_firmware_file.disabled = True
-        self.root.ids.b_write_default_eeprom.disabled = True
+        self.firmware_tab.ids.b_flash_firmware_file.disabled = True
+        self.firmware_tab.ids.b_write_default_eeprom.disabled = True
         self.root.ids.b_save_to_esc.disabled = True
 
-        threading.Thread(target=self.esc.write_firmware, args=(self.fw_file_full_path,)).start()
+        if FLASH_WORKER_ENABLED:
+            self.flash_fw_file_in_worker()
+            return
+
+        self.flash_percent_done = 0
+        self.flash_future = self.scheduler.write_firmware(
+            self.fw_file_full_path, progress_callback=self.callback_flash_progress
+        )
         Clock.schedule_interval(self.callback_update_flash_loadbar, 1)
 
+    def callback_flash_progress(self, chunks_written, num_chunks):
+        # called from the scheduler thread, only store it, the loadbar polls it
+        self.flash_percent_done = int((chunks_written / num_chunks) * 100)
+
     def callback_update_flash_loadbar(self, dt):
-        percent_done = self.esc.get_flash_done_percentage()
+        percent_done = self.flash_percent_done
         print(percent_done)
-        self.root.ids.pb_flash_fw_file.value = percent_done
-        if percent_done == 100:
-            self.root.ids.l_flash_fw_filename.text = "Flash written!"
-            self.root.ids.b_save_to_esc.disabled = False
-            self.root.ids.b_write_default_eeprom.disabled = False
-            return False
+        self.firmware_tab.ids.pb_flash_fw_file.value = percent_done
+        if not self.flash_future.done():
+            return True
+
+        if self.flash_future.exception() is not None:
+            self.firmware_tab.ids.l_flash_fw_filename.text = "ERR: %s" % str(self.flash_future.exception())
         else:
+            self.firmware_tab.ids.l_flash_fw_filename.text = "Flash written!"
+        self.flash_future = None
+        self.root.ids.b_save_to_esc.disabled = False
+        self.firmware_tab.ids.b_write_default_eeprom.disabled = False
+        return False
+
+    def flash_fw_file_in_worker(self):
+        # the worker process owns the port while flashing, release it once the running command is done
+        self.scheduler.stop(wait=False)
+        Clock.schedule_interval(self.callback_scheduler_stopped, 0.05)
+
+    def callback_scheduler_stopped(self, dt):
+        from AM32FlashWorker import AM32FlashWorker
+
+        if self.scheduler.is_alive():
             return True
+        installed_version = self.esc.installed_firmware_version
+        esc_name = self.esc.esc_name
+        self.scheduler = None
+        self.serial_port.close()
+        self.serial_port = None
+        self.esc = None
 
-    def open_serial_port(self, serial_device_name):
+        self.flash_worker = AM32FlashWorker()
+        self.flash_worker.start()
+        self.flash_worker.open_port(self.serial_device_name)
+        self.flash_worker.write_firmware(
+            self.fw_file_full_path, plan_cache_dir=self.get_flash_plan_cache_dir(),
+            flash_delta_filename=self.get_flash_delta_filename(), installed_version=installed_version,
+            esc_name=esc_name
+        )
+        self.flash_worker.shutdown()
+        Clock.schedule_interval(self.callback_flash_worker_events, 0.1)
+        return False
+
+    def callback_flash_worker_events(self, dt):
+        for event in self.flash_worker.get_events():
+            if event["event"] == "status":
+                self.firmware_tab.ids.l_flash_fw_filename.text = event["text"]
+            elif event["event"] == "progress":
+                self.firmware_tab.ids.pb_flash_fw_file.value = event["percent"]
+            elif event["event"] == "result" and event["command"] == "write_firmware":
+                self.firmware_tab.ids.l_flash_fw_filename.text = "Flash written!"
+            elif event["event"] == "error":
+                self.firmware_tab.ids.l_flash_fw_filename.text = "ERR: %s" % event["text"]
+            elif event["event"] == "exit":
+                # worker released the port, connect the GUI again
+                self.flash_worker = None
+                self.reconnect_esc()
+                return False
+        return True
+
+    def reconnect_esc(self):
+        from AM32ConnectWorker import AM32ConnectWorker
+
+        self.connect_worker = AM32ConnectWorker(
+            self.serial_device_name, self.open_serial_port,
+            on_status=self.callback_connect_status,
+            on_result=self.callback_reconnect_result,
+            on_error=self.callback_reconnect_error
+        )
+        self.connect_worker.start()
+
+    @mainthread
+    def callback_reconnect_error(self, text):
+        from kivy.uix.button import Button
+
+        # the config tabs are already built, only reconnecting the same device is offered
+        self.connect_worker = None
+        self.root.ids.bl_usb_serial_devices.clear_widgets()
+        self.root.ids.bl_usb_serial_devices.add_widget(
+            Button(text="retry %s" % self.serial_device_name, on_press=self.callback_button_retry_reconnect)
+        )
+        self.root.ids.l_usb_devices.text = text
+
+    def callback_button_retry_reconnect(self, instance):
+        print("callback_button_retry_reconnect", self, instance.text)
+        self.root.ids.bl_usb_serial_devices.clear_widgets()
+        self.root.ids.l_usb_devices.text = "connecting to %s" % self.serial_device_name
+        self.reconnect_esc()
+
+    @mainthread
+    def callback_reconnect_result(self, serial_port, esc, eeprom):
+        self.connect_worker = None
+        self.set_connected_esc(serial_port, esc)
+        # the eeprom reports the version from before the flash until the new firmware has run once
+        self.esc.installed_firmware_version = None
+        self.eeprom = eeprom
+        # the connect worker may have written the default eeprom, show the values of the new eeprom
+        self.update_config_items()
+        self.root.ids.l_usb_devices.text = "Connected to %s" % self.eeprom
+        self.root.ids.b_save_to_esc.disabled = False
+        self.firmware_tab.ids.b_write_default_eeprom.disabled = False
+
+    @staticmethod
+    def open_serial_device(serial_device_name):
+        """Opens the serial port, returns the port instance or None"""
         device_name = serial_device_name
 
         if platform == 'android':
+            from usb4a import usb
+            from usbserial4a import serial4a
+
             device = usb.get_usb_device(device_name)
             if not device:
-                self.serial_port = None
-                return
+                return None
 
             if not usb.has_usb_permission(device):
                 usb.request_usb_permission(device)
-                return
-            self.serial_port = serial4a.get_serial_port(
+                return None
+            return serial4a.get_serial_port(
                 device_name,
                 19200,
                 8,
@@ -251,8 +498,11 @@ class AM32SetupToolApp(App):
                 timeout=1
             )
         else:
+            from serial import Serial
+            from serial.serialutil import SerialException
+
             try:
-                self.serial_port = Serial(
+                return Serial(
                     device_name,
                     19200,
                     8,
@@ -261,13 +511,11 @@ class AM32SetupToolApp(App):
                     timeout=1
                 )
             except SerialException:
-                self.serial_port = None
-
-    def connect_esc(self):
-        self.esc = AM32Connector(serial_port_instance=self.serial_port)
+                return None
 
     @staticmethod
     def create_configitem_layout_page():
+        from kivy.uix.gridlayout import GridLayout
 
         layout = GridLayout(cols=1, spacing=0, size_hint_y=None)
         # Make sure the height is such that there is something to scroll.
@@ -276,6 +524,11 @@ class AM32SetupToolApp(App):
         return layout
 
     def create_config_tabs(self):
+        self.slider_list = [None] * len(self.eeprom.EEPROM)
+        self.text_info_list = [None] * len(self.eeprom.EEPROM)
+        self.checkbox_list = [None] * len(self.eeprom.EEPROM)
+        self.select_input_list = [None] * len(self.eeprom.EEPROM)
+
         for byte_info in self.eeprom.get_eeprom_byte_info_list():
             if byte_info["app_page"] == "hide":
                 continue
@@ -300,7 +553,19 @@ class AM32SetupToolApp(App):
                 )
                 self.pages[byte_info["app_page"]].add_widget(config_box)
 
+    def update_config_items(self):
+        """Shows the values of self.eeprom in the existing config tabs"""
+        for byte_number, slider in enumerate(self.slider_list):
+            if slider is not None:
+                # the value binding updates the text info
+                slider.value = self.eeprom[byte_number]
+        for byte_number, checkbox in enumerate(self.checkbox_list):
+            if checkbox is not None:
+                checkbox.active = self.eeprom[byte_number] == 1
+
     def update_serial_devices(self):
+        from kivy.uix.button import Button
+
         self.get_serial_devices()
         self.root.ids.bl_usb_serial_devices.clear_widgets()
 
@@ -316,16 +581,25 @@ class AM32SetupToolApp(App):
     def get_serial_devices(self):
         self.device_name_list = []
         if platform == 'android':
+            from usb4a import usb
+
             usb_device_list = usb.get_usb_device_list()
 
             self.device_name_list = [
                 device.getDeviceName() for device in usb_device_list
             ]
         else:
+            from serial.tools import list_ports
+
             usb_device_list = list_ports.comports()
             self.device_name_list = [port.device for port in usb_device_list]
 
     def create_configitem_slider(self, byte_number, min_value, max_value, value, scale, offset, label_text, callback):
+        from kivy.uix.boxlayout import BoxLayout
+        from kivy.uix.label import Label
+        from kivy.uix.slider import Slider
+        from kivy.uix.textinput import TextInput
+
         # first create two boxlayouts, one vertical and an horizontal around it
         vertical_box = BoxLayout(orientation="vertical", padding=10, spacing=10, size_hint_y=None, height=200)
         horizontal_box = BoxLayout(orientation="horizontal")
@@ -358,6 +632,10 @@ class AM32SetupToolApp(App):
         return vertical_box
 
     def create_configitem_checkbox(self, byte_number, value, label, callback):
+        from kivy.uix.boxlayout import BoxLayout
+        from kivy.uix.checkbox import CheckBox
+        from kivy.uix.label import Label
+
         # first a horizontal boxlayout
         horizontal_box = BoxLayout(orientation="horizontal", padding=10, spacing=10, size_hint_y=None, height=200)
 
@@ -0,0 +1,199 @@
+#!python3
+# -*- coding: utf-8 -*-
+
+"""
+    Tests for delta flashing: which installed image is trusted, the flash in progress markers
+    and the confirming readback, against the emulated ESC of the benchmarks.
+
+    usage: python -m pytest tests
+
+    Copyright Julian Wingert, 2023, Licensed under the GPL V3
+"""
+
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+from AM32Connector import AM32Connector
+from AM32eeprom import AM32eeprom
+from AM32FakeESC import AM32FakeESC
+from AM32FlashDelta import AM32FlashDelta
+
+
+__author__ = 'Julian Wingert'
+__copyright__ = 'Copyright 2023, AM32 ESC Setup Tool'
+__license__ = 'GPL V3'
+__version__ = '0.1'
+__maintainer__ = 'Julian Wingert'
+__status__ = 'testing'
+
+
+IMAGE_SIZE = 8 * 1024
+PAGE_SIZE = 1024
+CHUNKS_PER_PAGE = PAGE_SIZE // AM32Connector.CHUNK_SIZE
+ESC_NAME = b"TESTESC"
+
+
+class FlashAborted(Exception):
+    pass
+
+
+class FlashDeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.directory = self._directory.name
+        self.delta_filename = os.path.join(self.directory, "flash_delta.json")
+        rng = random.Random(0x4d32)
+        self.image_100 = rng.randbytes(IMAGE_SIZE)
+        # 1.01 differs from 1.00 in its second page only
+        self.image_101 = bytearray(self.image_100)
+        self.image_101[PAGE_SIZE + 10] ^= 0xff
+        self.image_101 = bytes(self.image_101)
+        self.file_100 = self.write_image("AM32_TEST_F051_1.00.bin", self.image_100)
+        self.file_101 = self.write_image("AM32_TEST_F051_1.01.bin", self.image_101)
+        self.fake_esc = AM32FakeESC()
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def write_image(self, name, image):
+        filename = os.path.join(self.directory, name)
+        with open(filename, mode="wb") as bin_file:
+            bin_file.write(image)
+        return filename
+
+    def connect(self, fake_esc=None, version=(1, 0), esc_name=ESC_NAME, wait_after_write=0.0005):
+        """:return: connector with flash delta, connected like the GUI does, the eeprom reports version"""
+        if fake_esc is None:
+            fake_esc = self.fake_esc
+        eeprom = AM32eeprom().get_eeprom_bytearray()
+        eeprom[3], eeprom[4] = version
+        eeprom[5:17] = esc_name.ljust(12, b"\x00")
+        connector = AM32Connector(serial_port_instance=fake_esc, wait_after_write=wait_after_write)
+        fake_esc.set_eeprom(eeprom, connector.eeprom_address)
+        connector.flash_delta = AM32FlashDelta(self.delta_filename)
+        self.assertNotEqual(connector.cmd_read_eeprom(), -1)
+        return connector
+
+    def flash(self, connector, filename, abort_after=None):
+        """:return: number of chunks written"""
+        def progress_callback(chunks_written, num_chunks):
+            if chunks_written == abort_after:
+                raise FlashAborted()
+
+        writes = connector.serial_port.flash_writes
+        connector.write_firmware(filename, progress_callback=progress_callback)
+        return connector.serial_port.flash_writes - writes
+
+    def get_flash(self, fake_esc=None):
+        if fake_esc is None:
+            fake_esc = self.fake_esc
+        start_address = AM32Connector.FLASH_START_ADDRESS
+        return bytes(fake_esc.flash[start_address:start_address + IMAGE_SIZE])
+
+    def test_first_flash_writes_everything(self):
+        connector = self.connect()
+        self.assertEqual(self.flash(connector, self.file_100), IMAGE_SIZE // AM32Connector.CHUNK_SIZE)
+        self.assertEqual(self.get_flash(), self.image_100)
+
+    def test_delta_writes_changed_page(self):
+        self.flash(self.connect(), self.file_100)
+        # the ESC booted 1.00, the eeprom reports it now
+        connector = self.connect(version=(1, 0))
+        self.assertEqual(self.flash(connector, self.file_101), CHUNKS_PER_PAGE)
+        self.assertEqual(self.get_flash(), self.image_101)
+
+    def test_delta_in_same_session(self):
+        connector = self.connect()
+        self.flash(connector, self.file_100)
+        self.assertEqual(self.flash(connector, self.file_101), CHUNKS_PER_PAGE)
+        self.assertEqual(self.flash(connector, self.file_100), CHUNKS_PER_PAGE)
+        self.assertEqual(self.get_flash(), self.image_100)
+
+    def test_stale_eeprom_version_is_not_trusted(self):
+        self.flash(self.connect(), self.file_100)
+        self.flash(self.connect(version=(1, 0)), self.file_101)
+        # 1.01 has not run yet, the eeprom still reports 1.00
+        connector = self.connect(version=(1, 0))
+        self.assertIsNone(connector.flash_delta.predict(
+            connector.get_flash_plan(self.file_100), self.file_100, connector.esc_name, (1, 0)
+        ))
+        self.assertEqual(self.flash(connector, self.file_100), IMAGE_SIZE // AM32Connector.CHUNK_SIZE)
+        self.assertEqual(self.get_flash(), self.image_100)
+
+    def test_unfinished_flash_writes_everything(self):
+        self.flash(self.connect(), self.file_100)
+        with self.assertRaises(FlashAborted):
+            self.flash(self.connect(version=(1, 0)), self.file_101, abort_after=3)
+
+        connector = self.connect(version=(1, 0))
+        self.assertTrue(connector.flash_delta.is_flash_in_progress(connector.esc_type, connector.esc_name))
+        self.assertIsNone(connector.installed_firmware_version)
+        self.assertEqual(self.flash(connector, self.file_101), IMAGE_SIZE // AM32Connector.CHUNK_SIZE)
+        self.assertEqual(self.get_flash(), self.image_101)
+        self.assertFalse(connector.flash_delta.is_flash_in_progress(connector.esc_type, connector.esc_name))
+
+    def test_other_esc_does_not_clear_unfinished_flash(self):
+        other_fake_esc = AM32FakeESC()
+        self.flash(self.connect(), self.file_100)
+        self.flash(self.connect(other_fake_esc), self.file_100)
+        with self.assertRaises(FlashAborted):
+            self.flash(self.connect(version=(1, 0)), self.file_101, abort_after=3)
+
+        # an ESC of the same type and name completes a flash of the version the first one reports
+        other_connector = self.connect(other_fake_esc, version=(1, 0))
+        self.flash(other_connector, self.file_100)
+
+        connector = self.connect(version=(1, 0))
+        self.assertEqual(self.flash(connector, self.file_100), IMAGE_SIZE // AM32Connector.CHUNK_SIZE)
+        self.assertEqual(self.get_flash(), self.image_100)
+
+    def test_other_esc_name_is_not_trusted(self):
+        self.flash(self.connect(), self.file_100)
+        connector = self.connect(version=(1, 0), esc_name=b"OTHERESC")
+        self.assertEqual(self.flash(connector, self.file_101), IMAGE_SIZE // AM32Connector.CHUNK_SIZE)
+
+    def test_predict_sample_is_unchanged(self):
+        connector = self.connect()
+        self.flash(connector, self.file_100)
+        plan = connector.get_flash_plan(self.file_101)
+        try:
+            chunk_indices, sample_index = connector.flash_delta.predict(
+                plan, self.file_101, connector.esc_name, (1, 0)
+            )
+        finally:
+            plan.close()
+        self.assertEqual(chunk_indices, list(range(CHUNKS_PER_PAGE, 2 * CHUNKS_PER_PAGE)))
+        self.assertNotIn(sample_index, chunk_indices)
+
+    def test_readback_mismatch_writes_everything(self):
+        self.flash(self.connect(), self.file_100)
+        # the flash changed behind the index' back
+        start_address = AM32Connector.FLASH_START_ADDRESS
+        self.fake_esc.flash[start_address:start_address + IMAGE_SIZE] = b"\xff" * IMAGE_SIZE
+        connector = self.connect(version=(1, 0))
+        self.assertEqual(self.flash(connector, self.file_101), IMAGE_SIZE // AM32Connector.CHUNK_SIZE)
+        self.assertEqual(self.get_flash(), self.image_101)
+
+    def test_readback_at_bootloader_baudrate(self):
+        self.flash(self.connect(), self.file_100)
+        # a 128 byte readback takes about 70 ms at 19200 baud, longer than one poll of the connector
+        self.fake_esc.byte_time = 10 / 19200
+        connector = self.connect(version=(1, 0), wait_after_write=0.025)
+        start_address = AM32Connector.FLASH_START_ADDRESS
+        self.assertEqual(
+            bytes(connector._read_direct(AM32Connector.CHUNK_SIZE, start_address)),
+            self.image_100[:AM32Connector.CHUNK_SIZE]
+        )
+        self.assertEqual(self.flash(connector, self.file_101), CHUNKS_PER_PAGE)
+        self.assertEqual(self.get_flash(), self.image_101)
+
+
+if __name__ == '__main__':
+    unittest.main()
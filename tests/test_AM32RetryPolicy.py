@@ -0,0 +1,197 @@
+#!python3
+# -*- coding: utf-8 -*-
+
+"""
+    Tests for resuming failed bootloader writes, AM32RetryPolicy and AM32Connector._send_frames
+    against the emulated ESC of the benchmarks with injected NACKs and lost ACKs.
+
+    usage: python -m pytest tests
+
+    Copyright Julian Wingert, 2023, Licensed under the GPL V3
+"""
+
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+from AM32Connector import AM32Connector
+from AM32FakeESC import AM32FakeESC
+from AM32RetryPolicy import AM32RetryPolicy, STAGE_ADDRESS, STAGE_BUFFER_SIZE, STAGE_PAYLOAD, STAGE_WRITE
+
+
+__author__ = 'Julian Wingert'
+__copyright__ = 'Copyright 2023, AM32 ESC Setup Tool'
+__license__ = 'GPL V3'
+__version__ = '0.1'
+__maintainer__ = 'Julian Wingert'
+__status__ = 'testing'
+
+
+ADDRESS = AM32Connector.FLASH_START_ADDRESS
+
+
+class ScriptedFakeESC(AM32FakeESC):
+    """Fake ESC whose error injections follow a script, True NACKs the next address, payload or write command"""
+
+    def __init__(self, script, **kwargs):
+        AM32FakeESC.__init__(self, **kwargs)
+        self.script = list(script)
+
+    def _inject_error(self):
+        if self.script and self.script.pop(0):
+            self.errors_injected += 1
+            return True
+        return False
+
+
+class RecordingConnector(AM32Connector):
+    """Records every stage a write was (re)started from, the stage that failed and the backoffs"""
+
+    def __init__(self, **kwargs):
+        self.writes = []        # per _send_frames call: list of (start stage, failed stage or None)
+        self.backoffs = []
+        AM32Connector.__init__(self, **kwargs)
+
+    def _send_frames(self, *args, **kwargs):
+        self.writes.append([])
+        return AM32Connector._send_frames(self, *args, **kwargs)
+
+    def _send_stages(self, stage, *args, **kwargs):
+        failed_stage = AM32Connector._send_stages(self, stage, *args, **kwargs)
+        self.writes[-1].append((stage, failed_stage))
+        return failed_stage
+
+    def _resync(self, backoff):
+        self.backoffs.append(backoff)
+        AM32Connector._resync(self, backoff)
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = AM32RetryPolicy(backoff_base=0.001, backoff_max=0.004)
+
+    def test_resume_stages(self):
+        self.assertEqual(self.policy.get_resume_stage(STAGE_PAYLOAD, 1), STAGE_BUFFER_SIZE)
+        self.assertEqual(self.policy.get_resume_stage(STAGE_PAYLOAD, 4), STAGE_BUFFER_SIZE)
+        self.assertEqual(self.policy.get_resume_stage(STAGE_PAYLOAD, 5), STAGE_ADDRESS)
+        self.assertEqual(self.policy.get_resume_stage(STAGE_WRITE, 2), STAGE_WRITE)
+        self.assertEqual(self.policy.get_resume_stage(STAGE_WRITE, 3), STAGE_ADDRESS)
+        self.assertEqual(self.policy.get_resume_stage(STAGE_ADDRESS, 1), STAGE_ADDRESS)
+
+    def test_backoff(self):
+        self.assertEqual([self.policy.get_backoff(retry) for retry in range(5)], [0.001, 0.002, 0.004, 0.004, 0.004])
+
+
+class SendFramesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = AM32RetryPolicy(backoff_base=0.001, backoff_max=0.004)
+        self.payload = bytes(random.Random(0x4d32).randbytes(AM32Connector.CHUNK_SIZE))
+
+    def connect(self, fake_esc):
+        return RecordingConnector(serial_port_instance=fake_esc, wait_after_write=0.0005, retry_policy=self.policy)
+
+    def send(self, connector):
+        """Writes self.payload to ADDRESS, :return: result of _send_frames"""
+        return connector._send_frames(
+            connector.build_set_address_frame(ADDRESS), connector.build_set_buffer_size_frame(len(self.payload)),
+            connector.build_frame(self.payload), len(self.payload)
+        )
+
+    def get_flash(self, fake_esc):
+        return bytes(fake_esc.flash[ADDRESS:ADDRESS + len(self.payload)])
+
+    def test_no_errors(self):
+        fake_esc = AM32FakeESC()
+        connector = self.connect(fake_esc)
+        self.assertEqual(self.send(connector), len(self.payload))
+        self.assertEqual(connector.writes, [[(STAGE_ADDRESS, None)]])
+        self.assertEqual(self.get_flash(fake_esc), self.payload)
+
+    def test_payload_resumes_from_buffer_size(self):
+        # address ok, two NACKed payloads, then payload and write ok
+        fake_esc = ScriptedFakeESC([False, True, True, False, False])
+        connector = self.connect(fake_esc)
+        self.assertEqual(self.send(connector), len(self.payload))
+        self.assertEqual(connector.writes, [[
+            (STAGE_ADDRESS, STAGE_PAYLOAD), (STAGE_BUFFER_SIZE, STAGE_PAYLOAD), (STAGE_BUFFER_SIZE, None)
+        ]])
+        self.assertEqual(connector.backoffs, [0.001, 0.002])
+        self.assertEqual(connector.stage_failures[STAGE_PAYLOAD], 2)
+        self.assertEqual(self.get_flash(fake_esc), self.payload)
+
+    def test_payload_over_budget_restarts_from_address(self):
+        # five NACKed payloads, one more than the payload budget
+        fake_esc = ScriptedFakeESC([False] + [True] * 5)
+        connector = self.connect(fake_esc)
+        self.assertEqual(self.send(connector), len(self.payload))
+        self.assertEqual([stage for stage, failed_stage in connector.writes[0]], [
+            STAGE_ADDRESS, STAGE_BUFFER_SIZE, STAGE_BUFFER_SIZE, STAGE_BUFFER_SIZE, STAGE_BUFFER_SIZE, STAGE_ADDRESS
+        ])
+        self.assertEqual(connector.writes[0][-1], (STAGE_ADDRESS, None))
+        self.assertEqual(self.get_flash(fake_esc), self.payload)
+
+    def test_write_nack_resumes_from_write(self):
+        # address and payload ok, NACKed write flash command
+        fake_esc = ScriptedFakeESC([False, False, True])
+        connector = self.connect(fake_esc)
+        self.assertEqual(self.send(connector), len(self.payload))
+        self.assertEqual(connector.writes, [[(STAGE_ADDRESS, STAGE_WRITE), (STAGE_WRITE, None)]])
+        self.assertEqual(fake_esc.flash_writes, 1)
+        self.assertEqual(self.get_flash(fake_esc), self.payload)
+
+    def test_lost_acks_use_up_write_budget_then_total(self):
+        fake_esc = AM32FakeESC(ack_loss_rate=1.0)
+        connector = self.connect(fake_esc)
+        self.assertEqual(self.send(connector), -1)
+        # write is resumed twice (its budget), then every retry restarts from the address until the total cap
+        self.assertEqual([stage for stage, failed_stage in connector.writes[0]], [
+            STAGE_ADDRESS, STAGE_WRITE, STAGE_WRITE
+        ] + [STAGE_ADDRESS] * (self.policy.total_retries - 2))
+        self.assertTrue(all(failed_stage == STAGE_WRITE for stage, failed_stage in connector.writes[0]))
+        self.assertEqual(connector.backoffs, [
+            self.policy.get_backoff(retry) for retry in range(self.policy.total_retries)
+        ])
+        # the ESC executed the write every time, only the ACKs got lost
+        self.assertEqual(fake_esc.flash_writes, self.policy.total_retries + 1)
+        self.assertEqual(self.get_flash(fake_esc), self.payload)
+
+    def test_total_cap(self):
+        fake_esc = AM32FakeESC(error_rate=1.0)
+        connector = self.connect(fake_esc)
+        self.assertEqual(self.send(connector), -1)
+        self.assertEqual(connector.writes, [[(STAGE_ADDRESS, STAGE_ADDRESS)] * (self.policy.total_retries + 1)])
+        self.assertEqual(connector.backoffs, [0.001, 0.002] + [0.004] * (self.policy.total_retries - 2))
+        self.assertEqual(fake_esc.flash_writes, 0)
+
+    def test_noisy_firmware_write(self):
+        """Every retry of a noisy flash follows the policy and the image ends up in the flash"""
+        image = random.Random(1).randbytes(8 * 1024)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "firmware.bin")
+            with open(filename, mode="wb") as bin_file:
+                bin_file.write(image)
+            fake_esc = AM32FakeESC(error_rate=0.1, ack_loss_rate=0.05, seed=7)
+            connector = self.connect(fake_esc)
+            connector.write_firmware(filename)
+
+        self.assertGreater(fake_esc.errors_injected, 0)
+        self.assertGreater(fake_esc.acks_lost, 0)
+        for write in connector.writes:
+            failures = {}
+            for (stage, failed_stage), (next_stage, next_failed_stage) in zip(write, write[1:]):
+                failures[failed_stage] = failures.get(failed_stage, 0) + 1
+                self.assertEqual(next_stage, self.policy.get_resume_stage(failed_stage, failures[failed_stage]))
+            self.assertIsNone(write[-1][1])
+            self.assertLessEqual(len(write), self.policy.total_retries + 1)
+        self.assertEqual(bytes(fake_esc.flash[ADDRESS:ADDRESS + len(image)]), image)
+
+
+if __name__ == '__main__':
+    unittest.main()